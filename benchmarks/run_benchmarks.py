@@ -0,0 +1,265 @@
+"""Offline performance benchmarks for the cdFBA hot paths.
+
+The benchmarks only use the models bundled in Notebooks/, so no downloads are needed:
+    dfba_update/<model>/<solver>               one `dFBA.update` call on the default medium
+    update_environment/<substrates>            one `UpdateEnvironment.update` call for 4 species
+    volumetric_update/<substrates>             one `volumetric_update` of the Shared Environment
+    make_cdfba_composite/<model>               spec construction
+    community_step/<species>                   one `Composite.run` step for a community of copies of one model
+    spatial_step/<voxels>                      one `SpatialDFBA.step` on an n x n x 1 lattice
+    import/<module>                            cold import of a cdFBA module in a fresh interpreter
+
+A run that takes longer than `IMPORT_BUDGET` to import the process registry exits with status 1, like a regression.
+
+Results are written as JSON with the median, mean, 90th percentile and minimum time of each benchmark in seconds.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --quick --output new.json --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import platform
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOTEBOOKS = os.path.join(ROOT, "Notebooks")
+MODELS = {
+    "iSO595v7": os.path.join(NOTEBOOKS, "iSO595v7.xml"),
+    "iRS840": os.path.join(NOTEBOOKS, "iRS840.xml"),
+    "S.anginosus": os.path.join(NOTEBOOKS, "representative_species", "Streptococcus_anginosus_1_2_62CV.xml"),
+    "B.fragilis": os.path.join(NOTEBOOKS, "representative_species", "Bacteroides_fragilis_NCTC_9343.mat"),
+}
+
+def summarize(times):
+    """Returns summary statistics of a list of times in seconds"""
+    times = np.asarray(times, dtype=float)
+    return {
+        "repeats": int(len(times)),
+        "median": float(np.median(times)),
+        "mean": float(times.mean()),
+        "p90": float(np.percentile(times, 90)),
+        "min": float(times.min()),
+    }
+
+def timed(function, repeats, warmup=1):
+    """Time repeated calls of a function"""
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+def get_core():
+    from process_bigraph import allocate_core
+    from cdFBA.data_types import register_types
+    return register_types(allocate_core())
+
+# modules that must not be imported by the process registry
+LAZY_MODULES = ["cobra", "optlang", "scipy.sparse", "matplotlib", "pytest", "highspy"]
+# median cold import time of cdFBA.processes in seconds, checked by the benchmark run rather than the test suite
+IMPORT_BUDGET = 0.25
+
+def import_time(module, after=("numpy", "pandas", "process_bigraph")):
+    """Import a module in a fresh interpreter
+    Parameters:
+        module: str, module to import
+        after: list of str, modules imported before the timer starts, so only the cost of `module` is measured
+    Returns:
+        seconds: float, import time of `module`
+        loaded: list of str, modules of `LAZY_MODULES` that were imported with it
+    """
+    script = (
+        f"import sys, time, json\n"
+        + "".join(f"import {name}\n" for name in after)
+        + f"start = time.perf_counter()\nimport {module}\nseconds = time.perf_counter() - start\n"
+        + f"print(json.dumps([seconds, [name for name in {LAZY_MODULES!r} if name in sys.modules]]))"
+    )
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    seconds, loaded = json.loads(output.stdout.strip().splitlines()[-1])
+    return seconds, loaded
+
+def environment_state(substrates, species):
+    counts = {f"substrate_{i}": 10.0 for i in range(substrates)}
+    counts.update({name: 0.5 for name in species})
+    return {"counts": counts, "concentrations": dict(counts), "volume": 1.0}
+
+#benchmarks
+def bench_dfba_update(results, core, models, repeats):
+    from cdFBA.processes.dfba import dFBA
+    from cdFBA.utils import make_cdfba_composite, SHARED_ENVIRONMENT, SPECIES_STORE
+    from cdFBA.solvers import highs_available
+    solvers = ["cobra"] + (["highs"] if highs_available() else [])
+    for name, path in models.items():
+        spec = make_cdfba_composite({name: path}, medium_type="default")
+        inputs = {"shared_environment": spec[SHARED_ENVIRONMENT], "current_update": {}}
+        for solver in solvers:
+            config = dict(spec[SPECIES_STORE][name]["config"], solver=solver)
+            process = dFBA(config, core)
+            results[f"dfba_update/{name}/{solver}"] = timed(lambda: process.update(inputs, 1.0), repeats)
+
+def bench_environment(results, core, sizes, repeats):
+    from cdFBA.processes.dfba import UpdateEnvironment
+    from cdFBA.data_types import Volumetric, volumetric_update
+    species = [f"species_{i}" for i in range(4)]
+    for substrates in sizes:
+        state = environment_state(substrates, species)
+        species_updates = {name: {key: -0.001 for key in state["counts"]} for name in species}
+        step = UpdateEnvironment({}, core)
+        inputs = {"shared_environment": state, "species_updates": species_updates}
+        results[f"update_environment/{substrates}"] = timed(lambda: step.update(inputs), repeats)
+
+        update = {"counts": {key: -0.001 for key in state["counts"]}}
+        results[f"volumetric_update/{substrates}"] = timed(
+            lambda: volumetric_update(Volumetric(), state, update, ()), repeats)
+
+def bench_spec_construction(results, models, repeats):
+    from cdFBA.utils import make_cdfba_composite
+    for name, path in models.items():
+        results[f"make_cdfba_composite/{name}"] = timed(
+            lambda: make_cdfba_composite({name: path}, medium_type="default"), repeats, warmup=0)
+
+def bench_community(results, core, path, sizes, steps):
+    from process_bigraph import Composite
+    from cdFBA.utils import make_cdfba_composite
+    for size in sizes:
+        spec = make_cdfba_composite({f"species_{i}": path for i in range(size)}, medium_type="default")
+        sim = Composite({"state": spec}, core=core)
+        sim.run(1)
+        times = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            sim.run(1)
+            times.append(time.perf_counter() - start)
+        results[f"community_step/{size}"] = summarize(times)
+
+def bench_spatial(results, core, path, sizes, steps):
+    from cdFBA.utils import make_cdfba_composite, SHARED_ENVIRONMENT
+    from cdFBA.processes.spatial import SpatialDFBA
+    spec = make_cdfba_composite({"species": path}, medium_type="default")
+    diffusion = {key: 0.1 for key in spec[SHARED_ENVIRONMENT]["concentrations"]}
+    for size in sizes:
+        spatial = SpatialDFBA(spec, [size, size, 1], 1.0, diffusion=diffusion, core=core)
+        results[f"spatial_step/{size * size}"] = timed(lambda: spatial.step(1.0), steps)
+
+def bench_import(results, modules, repeats):
+    for module in modules:
+        results[f"import/{module}"] = summarize([import_time(module)[0] for _ in range(repeats)])
+
+def metadata():
+    """Returns the commit, versions and platform of the benchmark run"""
+    import cobra
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cobra": cobra.__version__,
+        "numpy": np.__version__,
+    }
+
+def run_benchmarks(quick=False):
+    """Run all benchmarks
+    Parameters:
+        quick: bool, fewer repeats and smaller scaling sizes
+    Returns:
+        report: dict, {"metadata": ..., "results": {benchmark name: summary}, "errors": {benchmark name: message}}
+    """
+    core = get_core()
+    repeats = 5 if quick else 50
+    models = {name: path for name, path in MODELS.items() if os.path.exists(path)}
+    results, errors = {}, {}
+
+    for name, path in models.items():
+        for benchmark, arguments in [
+            (bench_dfba_update, (results, core, {name: path}, repeats)),
+            (bench_spec_construction, (results, {name: path}, 1 if quick else 3)),
+        ]:
+            try:
+                benchmark(*arguments)
+            except Exception as error:
+                errors[f"{benchmark.__name__}/{name}"] = repr(error)
+    bench_import(results, ["cdFBA.processes", "cdFBA.data_types"], 3 if quick else 10)
+    bench_environment(results, core, [10, 100] if quick else [10, 100, 1000], repeats * 10)
+    bench_community(results, core, MODELS["iSO595v7"], [1, 2] if quick else [1, 2, 4, 8], 3 if quick else 10)
+    bench_spatial(results, core, MODELS["iSO595v7"], [2, 4] if quick else [2, 4, 8], 2 if quick else 5)
+    return {"metadata": metadata(), "results": results, "errors": errors}
+
+def compare(baseline, current, threshold=0.2):
+    """Compare the median times of two benchmark reports
+    Parameters:
+        baseline: dict or str, benchmark report or path to its JSON file
+        current: dict or str, benchmark report or path to its JSON file
+        threshold: float, relative slowdown above which a benchmark counts as a regression
+    Returns:
+        rows: list of (name, baseline median, current median, ratio, regression) for benchmarks in both reports
+    """
+    reports = []
+    for report in (baseline, current):
+        if isinstance(report, str):
+            with open(report) as file:
+                report = json.load(file)
+        reports.append(report["results"])
+    baseline, current = reports
+    rows = []
+    for name in sorted(set(baseline) & set(current)):
+        ratio = current[name]["median"] / baseline[name]["median"]
+        rows.append((name, baseline[name]["median"], current[name]["median"], ratio, ratio > 1 + threshold))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline cdFBA benchmarks")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the results")
+    parser.add_argument("--quick", action="store_true", help="fewer repeats and smaller scaling sizes")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown counted as a regression")
+    arguments = parser.parse_args(argv)
+    # infeasible solves on the default media are expected and only add noise
+    warnings.filterwarnings("ignore", message="Solver status is")
+
+    report = run_benchmarks(quick=arguments.quick)
+    with open(arguments.output, "w") as file:
+        json.dump(report, file, indent=2)
+    for name, summary in report["results"].items():
+        print(f"{name:45s} {summary['median'] * 1e3:12.3f} ms")
+    for name, error in report["errors"].items():
+        print(f"{name:45s} failed: {error}")
+    over_budget = report["results"]["import/cdFBA.processes"]["median"] > IMPORT_BUDGET
+    if over_budget:
+        print(f"import/cdFBA.processes is over the {IMPORT_BUDGET * 1e3:.0f} ms import budget")
+
+    if arguments.compare:
+        rows = compare(arguments.compare, report, arguments.threshold)
+        print(f"\n{'benchmark':45s} {'baseline ms':>12s} {'current ms':>12s} {'ratio':>7s}")
+        for name, before, after, ratio, regression in rows:
+            flag = "  REGRESSION" if regression else ""
+            print(f"{name:45s} {before * 1e3:12.3f} {after * 1e3:12.3f} {ratio:7.2f}{flag}")
+        if any(row[-1] for row in rows):
+            return 1
+    return 1 if over_budget else 0
+
+#=======
+# TESTS
+#=======
+
+def test_lazy_imports():
+    """The process registry and the types load without cobra, sparse matrices, plotting or testing modules"""
+    for module in ("cdFBA.processes", "cdFBA.data_types"):
+        _, loaded = import_time(module, after=())
+        assert loaded == [], f"{module} imports {loaded}"
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""This module contains methods to compress a cobra model before a dFBA simulation.
+
+Compression removes reactions that are blocked under the current medium and bounds, lumps linear chains (a metabolite
+used by exactly two reactions fixes the ratio of their fluxes, so the two reactions are merged into one) and drops
+dead-end metabolites, repeating until nothing changes. The objective reaction and the given protected reactions
+(usually the exchanges in the dFBA `reaction_map`) keep their ids and are never lumped with other reactions, since dFBA
+overwrites the exchange bounds every step and would drop the bounds of a reaction merged into them. The compressed model
+is used exactly like the original. Every original reaction is mapped to (compressed reaction id, factor), and
+`expand_fluxes` maps the fluxes of the compressed model back onto the original reactions.
+
+CAUTION: Compressed models have no genes. Apply gene knockouts before compressing.
+"""
+import numpy as np
+import pandas as pd
+
+from cdFBA.utils import get_objective_reaction
+
+def _drop(reactions, mapping, members, usage, reaction_id):
+    """Remove a reaction that carries no flux"""
+    for metabolite in reactions[reaction_id]["metabolites"]:
+        del usage[metabolite][reaction_id]
+    for original in members.pop(reaction_id):
+        mapping[original] = (None, 0.0)
+    del reactions[reaction_id]
+
+def _lump(reactions, mapping, members, usage, kept, merged, metabolite):
+    """Merge reaction `merged` into reaction `kept` through a metabolite they share"""
+    a = reactions[kept]["metabolites"][metabolite]
+    b = reactions[merged]["metabolites"][metabolite]
+    # steady state of the metabolite: a * v_kept + b * v_merged = 0
+    factor = -a / b
+
+    for reaction_id in (kept, merged):
+        for key in reactions[reaction_id]["metabolites"]:
+            del usage[key][reaction_id]
+    metabolites = dict(reactions[kept]["metabolites"])
+    for key, coefficient in reactions[merged]["metabolites"].items():
+        metabolites[key] = metabolites.get(key, 0.0) + factor * coefficient
+    del metabolites[metabolite]
+    reactions[kept]["metabolites"] = {key: value for key, value in metabolites.items() if abs(value) > 1e-12}
+    for key in reactions[kept]["metabolites"]:
+        usage[key][kept] = None
+
+    lower, upper = reactions[merged]["lower"] / factor, reactions[merged]["upper"] / factor
+    if factor < 0:
+        lower, upper = upper, lower
+    reactions[kept]["lower"] = max(reactions[kept]["lower"], lower)
+    reactions[kept]["upper"] = min(reactions[kept]["upper"], upper)
+    reactions[kept]["objective"] += factor * reactions[merged]["objective"]
+    del reactions[merged]
+
+    for original in members.pop(merged):
+        target, original_factor = mapping[original]
+        mapping[original] = (kept, original_factor * factor)
+        members[kept].append(original)
+
+def compress_model(model, protected=None):
+    """Returns a compressed copy of a cobra model with the same optimum and the same fluxes through protected reactions
+    Parameters:
+        model: cobra model, with medium, bounds and knockouts already applied
+        protected: list of str, reaction ids to keep. Their lower bounds are opened to -1000 when looking for blocked
+                   reactions, so they can be used as dFBA exchanges
+    Returns:
+        compressed: cobra model
+        mapping: dict, original reaction ids as keys and (compressed reaction id, factor) as values. Removed
+                 reactions map to (None, 0.0)
+    """
+    from cobra import Model, Reaction
+    from cobra.flux_analysis import find_blocked_reactions
+
+    objective = get_objective_reaction(model)
+    protected = set(protected or []) | {objective}
+
+    with model:
+        for reaction_id in protected:
+            reaction = model.reactions.get_by_id(reaction_id)
+            reaction.lower_bound = min(reaction.lower_bound, -1000)
+        blocked = set(find_blocked_reactions(model, open_exchanges=False, processes=1)) - protected
+
+    reactions = {
+        reaction.id: {
+            "metabolites": {metabolite.id: coefficient for metabolite, coefficient in reaction.metabolites.items()},
+            "lower": reaction.lower_bound,
+            "upper": reaction.upper_bound,
+            "objective": reaction.objective_coefficient,
+        }
+        for reaction in model.reactions if reaction.id not in blocked
+    }
+    mapping = {reaction.id: ((None, 0.0) if reaction.id in blocked else (reaction.id, 1.0)) for reaction in model.reactions}
+    members = {reaction_id: [reaction_id] for reaction_id in reactions}
+    # reactions using each metabolite, kept up to date by every merge and removal (dicts keep the order deterministic)
+    usage = {metabolite.id: {} for metabolite in model.metabolites}
+    for reaction_id, reaction in reactions.items():
+        for metabolite in reaction["metabolites"]:
+            usage[metabolite][reaction_id] = None
+
+    changed = True
+    while changed:
+        changed = False
+        for metabolite, users in usage.items():
+            reaction_ids = list(users)
+            if len(reaction_ids) == 1 and reaction_ids[0] not in protected:
+                # dead end: the only reaction using the metabolite carries no flux
+                _drop(reactions, mapping, members, usage, reaction_ids[0])
+                changed = True
+            elif len(reaction_ids) == 2 and not protected.intersection(reaction_ids):
+                _lump(reactions, mapping, members, usage, *reaction_ids, metabolite)
+                changed = True
+        # reactions left without metabolites (e.g. lumped loops) have no effect on the network
+        for reaction_id in [key for key, reaction in reactions.items() if not reaction["metabolites"]]:
+            if reaction_id not in protected:
+                _drop(reactions, mapping, members, usage, reaction_id)
+                changed = True
+
+    compressed = Model(f"{model.id}_compressed")
+    metabolites = {metabolite.id: metabolite.copy() for metabolite in model.metabolites}
+    new_reactions = []
+    for reaction_id, reaction in reactions.items():
+        new_reaction = Reaction(reaction_id, model.reactions.get_by_id(reaction_id).name)
+        new_reaction.add_metabolites({metabolites[key]: value for key, value in reaction["metabolites"].items()})
+        new_reaction.bounds = (reaction["lower"], max(reaction["lower"], reaction["upper"]))
+        new_reactions.append(new_reaction)
+    compressed.add_reactions(new_reactions)
+    compressed.objective = {
+        compressed.reactions.get_by_id(reaction_id): reaction["objective"]
+        for reaction_id, reaction in reactions.items() if reaction["objective"] != 0
+    }
+    compressed.solver = model.solver.interface
+    return compressed, mapping
+
+def expand_fluxes(fluxes, mapping):
+    """Maps the fluxes of a compressed model onto the reactions of the original model
+    Parameters:
+        fluxes: pd.Series or dict, fluxes of the compressed model by reaction id
+        mapping: dict, as returned by `compress_model`
+    Returns:
+        fluxes: pd.Series, fluxes of the original model in its reaction order
+    """
+    return pd.Series(
+        [0.0 if target is None else factor * fluxes[target] for target, factor in mapping.values()],
+        index=list(mapping.keys()),
+    )
+
+#=======
+# TESTS
+#=======
+
+def test_compress_model():
+    from cdFBA.utils import model_from_file
+    model = model_from_file("textbook")
+    exchanges = ["EX_glc__D_e", "EX_ac_e"]
+    compressed, mapping = compress_model(model, protected=exchanges)
+    assert len(compressed.reactions) < len(model.reactions)
+    assert len(compressed.metabolites) < len(model.metabolites)
+    assert set(exchanges) <= {reaction.id for reaction in compressed.reactions}
+    assert list(mapping.keys()) == [reaction.id for reaction in model.reactions]
+
+    for bounds in [(-10.0, 0.0), (-2.0, -3.0), (0.0, -5.0)]:
+        for network in (model, compressed):
+            network.reactions.EX_glc__D_e.lower_bound, network.reactions.EX_ac_e.lower_bound = bounds
+        solution = model.optimize()
+        compressed_solution = compressed.optimize()
+        assert np.isclose(compressed_solution.objective_value, solution.objective_value)
+
+        # the expanded fluxes are a steady state of the original model within its bounds
+        fluxes = expand_fluxes(compressed_solution.fluxes, mapping)
+        stoichiometry = np.zeros((len(model.metabolites), len(model.reactions)))
+        for column, reaction in enumerate(model.reactions):
+            for metabolite, coefficient in reaction.metabolites.items():
+                stoichiometry[model.metabolites.index(metabolite), column] = coefficient
+        assert np.allclose(stoichiometry @ fluxes.to_numpy(), 0, atol=1e-6)
+        lower = np.array([reaction.lower_bound for reaction in model.reactions])
+        upper = np.array([reaction.upper_bound for reaction in model.reactions])
+        assert np.all(fluxes.to_numpy() >= lower - 1e-6) and np.all(fluxes.to_numpy() <= upper + 1e-6)
+        for exchange in exchanges:
+            assert np.isclose(fluxes[exchange], compressed_solution.fluxes[exchange])
+
+    # an internal bound next to an exchange is kept when dFBA sets the exchange bound
+    model = model_from_file("textbook")
+    model.reactions.GLCpts.upper_bound = 4
+    compressed, _ = compress_model(model, protected=exchanges)
+    for network in (model, compressed):
+        network.reactions.EX_glc__D_e.lower_bound = -10
+    assert np.isclose(compressed.slim_optimize(), model.slim_optimize())
+
+def test_dfba_compress(core):
+    from cdFBA.processes.dfba import dFBA, get_textbook_test_case
+    config, inputs = get_textbook_test_case()
+    original = dFBA(config, core)
+    compressed = dFBA(dict(config, compress=True), core)
+    assert len(compressed.model.reactions) < len(original.model.reactions)
+    exact = original.update(inputs, 1.0)["dfba_update"]
+    for key, value in compressed.update(inputs, 1.0)["dfba_update"].items():
+        assert np.isclose(value, exact[key])
@@ -3,6 +3,7 @@ from bigraph_schema.schema import Node, Map, List, Float
 from bigraph_schema.methods import apply
 from cdFBA.processes import register_processes
 from plum import dispatch
+from cdFBA.profiling import phase
 
 #====================
 #Volumetric Dataclass
@@ -66,7 +67,8 @@ def volumetric_update(schema, current, update, path):
 
 @apply.dispatch
 def apply(schema: Volumetric, current, update, path):
-    return volumetric_update(schema, current, update, path)
+    with phase("volumetric", "apply"):
+        return volumetric_update(schema, current, update, path)
 
 # @dispatch
 # def resolve(current: Volumetric, update: Map, path=None):
@@ -95,6 +97,24 @@ dfba_changes_type = {
     "kinetics": "map",
 }
 
+solver_telemetry_type = {
+    "status": "overwrite[string]",  # solver status of the last solve, e.g. "optimal" or "infeasible"
+    "iterations": "overwrite[integer]",  # simplex iterations, -1 if the solver does not report them
+    "solve_time": "overwrite[float]",  # seconds spent in the solver
+    "objective": "overwrite[float]",
+    "warm_start": "overwrite[boolean]",  # solve started from the basis of the previous solve
+    "cache_hit": "overwrite[boolean]",  # fluxes reused from an identical solve
+    "skipped": "overwrite[boolean]",  # no solve this step
+    "surrogate": "overwrite[boolean]",  # fluxes evaluated from the surrogate
+    "dormant": "overwrite[boolean]",  # biomass below the dormancy threshold, no solve and a zero update
+}
+
+convergence_type = {
+    "converged": "overwrite[boolean]",
+    "reason": "overwrite[string]",  # criterion that was met: "substrates exhausted", "no growth" or "steady state"
+    "time": "overwrite[float]",  # global time at which it was met
+}
+
 threshold_type = {
     "type": "string",  # add or remove
     "substrate": "string",  # substrate or species to monitor
@@ -114,5 +134,7 @@ def register_types(core):
     core.register_type("volumetric", Volumetric)
     core.register_type("threshold", threshold_type)
     core.register_type("dfba_changes", dfba_changes_type)
+    core.register_type("solver_telemetry", solver_telemetry_type)
+    core.register_type("convergence", convergence_type)
 
     return register_processes(core)
@@ -0,0 +1,150 @@
+"""This module contains methods to run ensembles of a cdFBA composite over kinetic parameters, initial conditions
+and volumes.
+
+A parameter table has one row per ensemble member and one column per parameter. Parameter names are:
+    "volume"                                    environment volume (concentrations are kept)
+    "concentration/<substrate>"                 initial concentration of a substrate or species
+    "kinetics/<species>/<substrate>"            (Km, Vmax) tuple
+    "kinetics/<species>/<substrate>/Km"         Km only
+    "kinetics/<species>/<substrate>/Vmax"       Vmax only
+"""
+import copy
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from process_bigraph import Composite, allocate_core
+
+from cdFBA.utils import SHARED_ENVIRONMENT, SPECIES_STORE
+from cdFBA.utils import cached_model, set_concentration, set_kinetics, get_environment_emitter_spec
+
+#parameter tables
+def grid_table(parameters):
+    """Returns a parameter table with every combination of the given values
+    Parameters:
+        parameters: dict, parameter names as keys and lists of values as values
+    Returns:
+        table: pd.DataFrame, one row per member
+    """
+    names = list(parameters.keys())
+    rows = [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+    return pd.DataFrame(rows, columns=names)
+
+def latin_hypercube_table(ranges, members, seed=None):
+    """Returns a Latin hypercube sample of scalar parameters
+    Parameters:
+        ranges: dict, parameter names as keys and (low, high) tuples as values
+        members: int, number of ensemble members
+        seed: int, random seed
+    Returns:
+        table: pd.DataFrame, one row per member
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name, (low, high) in ranges.items():
+        strata = (rng.permutation(members) + rng.random(members)) / members
+        columns[name] = low + strata * (high - low)
+    return pd.DataFrame(columns)
+
+def apply_parameters(spec, parameters):
+    """Returns a copy of a cdFBA composite spec with the parameters of one ensemble member applied
+    Parameters:
+        spec: dict, cdFBA composite spec
+        parameters: dict, parameter names as keys and values as values (see module docstring)
+    Returns:
+        spec: dict, modified copy
+    """
+    spec = copy.deepcopy(spec)
+    if "volume" in parameters:
+        environment = spec[SHARED_ENVIRONMENT]
+        environment["volume"] = parameters["volume"]
+        environment["counts"] = {key: value * environment["volume"] for key, value in environment["concentrations"].items()}
+    for name, value in parameters.items():
+        parts = name.split("/")
+        if parts[0] == "concentration":
+            set_concentration(spec, {parts[1]: value})
+        elif parts[0] == "kinetics":
+            species, substrate = parts[1], parts[2]
+            if len(parts) == 3:
+                set_kinetics(species, spec, {substrate: tuple(value)})
+            else:
+                Km, Vmax = spec[SPECIES_STORE][species]["config"]["kinetics"][substrate]
+                kinetics = (value, Vmax) if parts[3] == "Km" else (Km, value)
+                set_kinetics(species, spec, {substrate: kinetics})
+        elif name != "volume":
+            raise ValueError(f"Unknown ensemble parameter {name}")
+    return spec
+
+#ensemble runs
+_WORKER_CORE = None
+
+def _init_worker(model_files):
+    """Load the models and core once per worker process"""
+    global _WORKER_CORE
+    from cdFBA.data_types import register_types
+    _WORKER_CORE = register_types(allocate_core())
+    for model_file in model_files:
+        cached_model(model_file, copy=False)
+
+def _run_member(args):
+    spec, parameters, duration = args
+    spec = apply_parameters(spec, parameters)
+    spec["emitter"] = get_environment_emitter_spec()
+    sim = Composite({"state": spec}, core=_WORKER_CORE)
+    sim.run(duration)
+    return sim.state["emitter"]["instance"].to_dataframe("concentrations").copy()
+
+def run_ensemble(spec, table, duration, workers=1, chunksize=1):
+    """Run every member of an ensemble and collect the Shared Environment concentrations
+    Parameters:
+        spec: dict, base cdFBA composite spec (see `make_cdfba_composite`), without an emitter
+        table: pd.DataFrame or list of dict, one row of parameters per member
+        duration: float, time to run each member
+        workers: int, number of worker processes. Runs in this process if 1
+        chunksize: int, number of members sent to a worker at once
+    Returns:
+        results: pd.DataFrame, concentrations with a (member, global_time) index
+    """
+    if isinstance(table, pd.DataFrame):
+        members = table.to_dict("records")
+    else:
+        members = list(table)
+    model_files = {species["config"]["model_file"] for species in spec[SPECIES_STORE].values()}
+    tasks = [(spec, parameters, duration) for parameters in members]
+
+    if workers == 1:
+        _init_worker(model_files)
+        trajectories = [_run_member(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_files,)) as pool:
+            trajectories = list(pool.map(_run_member, tasks, chunksize=chunksize))
+
+    return pd.concat(trajectories, keys=range(len(trajectories)), names=["member", "global_time"])
+
+#=======
+# TESTS
+#=======
+
+def test_ensemble():
+    from cdFBA.utils import make_cdfba_composite
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+
+    table = grid_table({
+        "concentration/D-Glucose": [5.0, 20.0],
+        "kinetics/E.coli/D-Glucose/Vmax": [5.0, 15.0],
+    })
+    assert len(table) == 4
+    assert len(latin_hypercube_table({"volume": (1, 2), "concentration/Acetate": (0, 5)}, members=8, seed=0)) == 8
+
+    member = apply_parameters(spec, {"volume": 2, "kinetics/E.coli/D-Glucose": (0.1, 10)})
+    assert member[SHARED_ENVIRONMENT]["counts"]["D-Glucose"] == 2 * spec[SHARED_ENVIRONMENT]["counts"]["D-Glucose"]
+    assert member[SPECIES_STORE]["E.coli"]["config"]["kinetics"]["D-Glucose"] == (0.1, 10)
+
+    results = run_ensemble(spec, table, duration=3, workers=2)
+    assert list(results.index.get_level_values("member").unique()) == [0, 1, 2, 3]
+    final = results.xs(3.0, level="global_time")
+    # more glucose gives more biomass
+    assert final.loc[2, "E.coli"] > final.loc[0, "E.coli"]
+    assert final.loc[3, "E.coli"] > final.loc[1, "E.coli"]
@@ -1,5 +1,7 @@
-from cdFBA.processes.dfba import dFBA, UpdateEnvironment, StaticConcentration, Injector, WaveFunction
-from cdFBA.processes.dfbalauncher import EnvironmentMonitor
+from cdFBA.processes.dfba import dFBA, UpdateEnvironment, StaticConcentration, Injector, WaveFunction, Chemostat
+from cdFBA.processes.dfba import TimeSeriesConcentration
+from cdFBA.processes.dfbalauncher import EnvironmentMonitor, ConvergenceMonitor
+from cdFBA.processes.emitters import EnvironmentEmitter, ChunkedEmitter
 
 def register_processes(core):
     core.register_link('dFBA', dFBA)
@@ -7,6 +9,11 @@ def register_processes(core):
     core.register_link('StaticConcentration', StaticConcentration)
     core.register_link('Injector', Injector)
     core.register_link('WaveFunction', WaveFunction)
+    core.register_link('Chemostat', Chemostat)
+    core.register_link('TimeSeriesConcentration', TimeSeriesConcentration)
     core.register_link('EnvironmentMonitor', EnvironmentMonitor)
+    core.register_link('ConvergenceMonitor', ConvergenceMonitor)
+    core.register_link('EnvironmentEmitter', EnvironmentEmitter)
+    core.register_link('ChunkedEmitter', ChunkedEmitter)
     
     return core
\ No newline at end of file
@@ -1,6 +1,10 @@
+import os
+import time
 import random
+import numpy as np
+import pandas as pd
 import pprint
-import pytest
+import warnings
 from math import isclose, sin
 from itertools import cycle
 
@@ -8,10 +12,15 @@ from process_bigraph import Process, Step, Composite, allocate_core
 from process_bigraph.emitter import gather_emitter_results, emitter_from_wires
 
 from cdFBA.utils import SHARED_ENVIRONMENT
-from cdFBA.utils import model_from_file, get_injector_spec, get_wave_spec, get_static_spec, set_concentration
+from cdFBA.utils import cached_model, get_injector_spec, get_wave_spec, get_static_spec, set_concentration
+from cdFBA.utils import get_chemostat_spec, get_timeseries_spec
 from cdFBA.utils import  make_cdfba_composite, set_kinetics, get_objective_reaction
-
-from matplotlib import pyplot as plt
+from cdFBA.processes.emitters import FluxRecorder
+from cdFBA.surrogate import FBASurrogate, build_dfba_surrogate, dfba_surrogate_signature
+from cdFBA.compression import compress_model, expand_fluxes
+from cdFBA.solvers import HighsLP, composite_solve_cache, lp_iterations, solve_signature, uptake_bounds
+from cdFBA.profiling import profiled, phase
+from cdFBA.timeseries import TimeSeries
 
 
 class dFBA(Process):
@@ -24,6 +33,37 @@ class dFBA(Process):
     kinetics: dict, dictionary of tuples with kinetic parameters (km, Vmax)
     reaction_map: dict, maps substrate names to reaction IDs
     bounds: dict, maps reaction IDs to a bounds dictionary
+    flux_record: dict, optional full-flux recording (see `FluxRecorder`), with keys
+        "path" (output directory, one subdirectory per species), "steps" (steps to preallocate),
+        "decimation" (record every Nth step, default 1) and "sparse_threshold" (default None, dense)
+    surrogate: dict, optional response-surface surrogate used instead of the LP (see `FBASurrogate`), with keys
+        "points" (grid points per substrate, default 9), "tolerance" (largest accepted cell error, default 1e-6)
+        and "path" (.npz file, loaded if it exists and was built for the same config, otherwise built and saved there).
+        The LP is solved where the surrogate is not accurate enough. Cannot be combined with flux_record
+    compress: bool, solve a compressed copy of the model without blocked reactions, linear chains and dead-end
+        metabolites (see `compress_model`). Recorded fluxes are mapped back onto the original reactions
+    solver: str, "cobra" (default) to solve through cobra/optlang, or "highs" to solve the extracted LP directly with
+        HiGHS (see `HighsLP`, requires highspy). The cobra model is still used for construction and knockouts
+    telemetry: bool, add a "solver_telemetry" output port reporting the status, iterations, time and objective of
+        each step's solve (see `solver_telemetry_type`). Wired to the Solver Telemetry store by `get_single_dfba_spec`
+    multirate: dict, optional multi-rate mode. The process still updates every interval, but only re-solves the LP
+        when its own solve interval has passed or its uptake bounds have moved; in between it reuses the fluxes of the
+        last solve per unit biomass. Keys are "growth_tolerance" (relative biomass change allowed between solves,
+        default 0.05, which sets the solve interval from the growth rate), "max_interval" (longest solve interval,
+        default 10 intervals) and "bound_tolerance" (re-solve when any uptake bound moves by more than this fraction
+        of its Vmax, default 0.05)
+    integrator: str, "euler" (default) advances biomass and substrates by rate * biomass * interval. "exponential"
+        uses the exact solution for fixed fluxes within the interval and shortens sub-steps when a substrate runs
+        out, so larger intervals give the same accuracy
+    dilution_rate: float, washout rate of the species' biomass in a chemostat (see `Chemostat` for the substrates)
+    max_substeps: int, largest number of solves per interval for the exponential integrator (default 10)
+    dormancy_threshold: float, biomass concentration below which the species is dormant: no LP is solved and the
+        biomass is only washed out until it recovers (e.g. through an Injector). Default 0.0, never dormant
+    share_solves: bool, reuse the result of an identical LP solved by another species of the same composite in the
+        same time step (same model file, medium, bounds, changes, substrate concentrations and uptake bounds, see
+        `SolveCache`). Cannot be combined with flux_record
+
+    Steps whose solve is not optimal return a zero update, apart from the washout of the biomass at the dilution rate.
     """
     config_schema = {
         "model_file": {
@@ -35,13 +75,42 @@ class dFBA(Process):
         "reaction_map": "map",
         "bounds": "maybe[map[bounds]]",
         "changes": "dfba_changes",
-        "medium": "maybe[map]"
+        "medium": "maybe[map]",
+        "flux_record": "maybe[map]",
+        "surrogate": "maybe[map]",
+        "compress": {
+            "_type": "boolean",
+            "_default": False,
+        },
+        "solver": {
+            "_type": "string",
+            "_default": "cobra",
+        },
+        "telemetry": {
+            "_type": "boolean",
+            "_default": False,
+        },
+        "multirate": "maybe[map]",
+        "integrator": {
+            "_type": "string",
+            "_default": "euler",
+        },
+        "dilution_rate": "float",
+        "max_substeps": {
+            "_type": "integer",
+            "_default": 10,
+        },
+        "dormancy_threshold": "float",
+        "share_solves": {
+            "_type": "boolean",
+            "_default": False,
+        },
     }
     #TODO -- add ability to change objective reaction
     def __init__(self, config, core):
         super().__init__(config, core)
 
-        self.model = model_from_file(self.config["model_file"])
+        self.model = cached_model(self.config["model_file"])
         self.biomass_identifier = get_objective_reaction(self.model)
 
         if len(self.config["medium"]) > 0:
@@ -71,48 +140,336 @@ class dFBA(Process):
             if len(self.config["changes"]["kinetics"]) > 0:
                 self.config["kinetics"].update(self.config["changes"]["kinetics"])
 
+        reaction_ids = [reaction.id for reaction in self.model.reactions]
+        self.flux_mapping = None
+        if self.config.get("compress"):
+            self.model, self.flux_mapping = compress_model(self.model, list(self.config["reaction_map"].values()))
+
+        self.lp = None
+        if self.config.get("solver", "cobra") == "highs":
+            self.lp = HighsLP(self.model)
+            self.exchange_indices = self.lp.indices(self.config["reaction_map"].values())
+            self.output_indices = self.lp.indices([self.biomass_identifier, *self.config["reaction_map"].values()])
+        elif self.config.get("solver", "cobra") != "cobra":
+            raise ValueError(f"Unknown dFBA solver {self.config['solver']}")
+
+        self.solves = 0
+        self.telemetry = None
+        self.dormant = False
+        self.signature = solve_signature(self.config) if self.config.get("share_solves") else None
+
+        self.multirate = self.config.get("multirate")
+        self.cached_fluxes = None
+        self.cached_bounds = None
+        self.next_solve = 0.0
+
+        self.flux_recorder = None
+        self.time = 0.0
+        if self.config.get("flux_record") is not None:
+            if self.signature is not None:
+                raise ValueError("Shared solves do not compute full fluxes for every species and cannot record them")
+            record = self.config["flux_record"]
+            self.flux_recorder = FluxRecorder(
+                os.path.join(record["path"], self.config["name"]),
+                reaction_ids,
+                steps=record["steps"],
+                decimation=record.get("decimation", 1),
+                sparse_threshold=record.get("sparse_threshold"),
+            )
+
+        self.surrogate = None
+        if self.config.get("surrogate") is not None:
+            if self.flux_recorder is not None:
+                raise ValueError("The dFBA surrogate mode does not compute full fluxes and cannot record them")
+            surrogate = self.config["surrogate"]
+            path = surrogate.get("path")
+            points = surrogate.get("points", 9)
+            signature = dfba_surrogate_signature(self.config, points)
+            if path is not None and os.path.exists(path):
+                self.surrogate = FBASurrogate.load(path)
+                if self.surrogate.signature != signature:
+                    warnings.warn(f"The surrogate at {path} was built for another dFBA config, rebuilding it")
+                    self.surrogate = None
+            if self.surrogate is None:
+                self.surrogate = build_dfba_surrogate(
+                    self.model, self.config["reaction_map"], self.config["kinetics"], points, signature)
+                if path is not None:
+                    self.surrogate.save(path)
+            self.surrogate_tolerance = surrogate.get("tolerance", 1e-6)
+
+    def __del__(self):
+        # release the flux recording files when the process is torn down
+        if getattr(self, "flux_recorder", None) is not None:
+            self.flux_recorder.close()
+
     def inputs(self):
+        # only the substrates in the reaction map and the species' own biomass are read
+        keys = [*self.config["reaction_map"].keys(), self.config["name"]]
         return {
-            "shared_environment": "volumetric", #initial conditions for time-step
+            "shared_environment": { #initial conditions for time-step
+                "counts": {key: "float" for key in keys},
+                "concentrations": {key: "float" for key in keys},
+                "volume": "float",
+            },
             "current_update": "map[map[overwrite[float]]]",
         }
 
     def outputs(self):
-        return {
+        outputs = {
              "dfba_update": "map[overwrite[float]]"
         }
+        if self.config.get("telemetry"):
+            outputs["solver_telemetry"] = "solver_telemetry"
+        return outputs
+
+    def record_fluxes(self, fluxes):
+        """Record the fluxes of the solved model, mapped back onto the original reactions if it is compressed"""
+        if self.flux_mapping is not None:
+            fluxes = expand_fluxes(fluxes, self.flux_mapping)
+        self.flux_recorder.record(self.time, fluxes.to_numpy())
+
+    def solve(self, lower_bounds):
+        """Solve the LP under the given exchange lower bounds and fill in the telemetry of the solve
+        Parameters:
+            lower_bounds: list of float, lower bounds of the `reaction_map` exchanges
+        Returns:
+            fluxes: list of float, objective flux followed by the exchange fluxes, or None if the solve is not optimal
+        """
+        self.telemetry["warm_start"] = self.solves > 0
+        self.solves += 1
+        if self.lp is not None:
+            with phase(self, "bounds"):
+                self.lp.set_lower_bounds(self.exchange_indices, lower_bounds)
+            with phase(self, "solve"):
+                start = time.perf_counter()
+                status = self.lp.optimize()
+                self.telemetry["solve_time"] = time.perf_counter() - start
+            self.telemetry.update(status=status, iterations=self.lp.iterations)
+            if status != "optimal":
+                return None
+            all_fluxes = self.lp.fluxes()
+            self.telemetry["objective"] = self.lp.objective_value
+            if self.flux_recorder is not None:
+                with phase(self, "record"):
+                    self.record_fluxes(pd.Series(all_fluxes, index=self.lp.reaction_ids))
+            return list(all_fluxes[self.output_indices])
+
+        # use the fluxes to constrain fba
+        with phase(self, "bounds"):
+            for reaction_id, lower_bound in zip(self.config["reaction_map"].values(), lower_bounds):
+                self.model.reactions.get_by_id(reaction_id).lower_bound = lower_bound
 
+        # solve fba under these constraints
+        iterations = lp_iterations(self.model)
+        with phase(self, "solve"):
+            start = time.perf_counter()
+            solution = self.model.optimize()
+            self.telemetry["solve_time"] = time.perf_counter() - start
+        if iterations >= 0:
+            iterations = lp_iterations(self.model) - iterations
+        self.telemetry.update(status=solution.status, iterations=iterations)
+        if solution.status != "optimal":
+            return None
+        self.telemetry["objective"] = solution.objective_value
+        if self.flux_recorder is not None:
+            with phase(self, "record"):
+                self.record_fluxes(solution.fluxes)
+        fluxes = [solution.fluxes[self.biomass_identifier]]
+        fluxes += [solution.fluxes[reaction_id] for reaction_id in self.config["reaction_map"].values()]
+        return fluxes
+
+    def reuse_fluxes(self, lower_bounds):
+        """Returns True if the multi-rate mode can reuse the fluxes of the last solve for these uptake bounds"""
+        if self.cached_bounds is None or self.time >= self.next_solve:
+            return False
+        tolerance = self.multirate.get("bound_tolerance", 0.05)
+        for substrate_id, lower_bound, cached in zip(self.config["reaction_map"], lower_bounds, self.cached_bounds):
+            if abs(lower_bound - cached) > tolerance * self.config["kinetics"][substrate_id][1]:
+                return False
+        return True
+
+    def schedule_solve(self, fluxes, lower_bounds, interval):
+        """Cache the fluxes of a solve and choose when the multi-rate mode solves next, from the growth rate"""
+        self.cached_fluxes = fluxes
+        self.cached_bounds = lower_bounds
+        max_interval = self.multirate.get("max_interval", 10 * interval)
+        if fluxes is None or fluxes[0] == 0:
+            # no growth: re-solve when the uptake bounds move
+            solve_interval = max_interval
+        else:
+            solve_interval = self.multirate.get("growth_tolerance", 0.05) / abs(fluxes[0])
+        self.next_solve = self.time + min(max(solve_interval, interval), max_interval)
+
+    def uptake_bounds(self, concentrations):
+        """Returns the Michaelis-Menten lower bounds of the reaction_map exchanges at the given concentrations"""
+        substrates = self.config["reaction_map"].keys()
+        kinetics = [self.config["kinetics"][substrate_id] for substrate_id in substrates]
+        return uptake_bounds(kinetics, [concentrations[substrate_id] for substrate_id in substrates]).tolist()
+
+    def fluxes_for(self, concentrations, interval):
+        """Returns the objective flux followed by the exchange fluxes under the uptake bounds at the given substrate
+        concentrations, from the multi-rate cache, the surrogate, an identical solve of another species or the LP.
+        Returns None if there is no optimal solution"""
+        lower_bounds = self.uptake_bounds(concentrations)
+        if self.multirate is not None and self.reuse_fluxes(lower_bounds):
+            # fluxes of the last solve, None if it was not optimal
+            self.telemetry["skipped"] = True
+            if self.cached_fluxes is not None:
+                self.telemetry["objective"] = float(self.cached_fluxes[0])
+            return self.cached_fluxes
+        if self.surrogate is not None:
+            with phase(self, "surrogate"):
+                fluxes = self.surrogate.evaluate(lower_bounds, self.surrogate_tolerance)
+            if fluxes is not None:
+                self.telemetry["surrogate"] = True
+                self.telemetry["objective"] = float(fluxes[0])
+                return fluxes
+        cache, global_time = composite_solve_cache() if self.signature is not None else (None, None)
+        if cache is not None:
+            environment = tuple(concentrations[substrate_id] for substrate_id in self.config["reaction_map"])
+            key = (self.signature, environment, tuple(lower_bounds))
+            shared = cache.lookup(key, global_time)
+            if shared is not None:
+                status, fluxes = shared
+                self.telemetry.update(status=status, cache_hit=True)
+                if fluxes is not None:
+                    self.telemetry["objective"] = float(fluxes[0])
+            else:
+                fluxes = self.solve(lower_bounds)
+                cache.store(key, self.telemetry["status"], fluxes)
+        else:
+            fluxes = self.solve(lower_bounds)
+        if self.multirate is not None:
+            self.schedule_solve(fluxes, lower_bounds, interval)
+        return fluxes
+
+    def washout(self, biomass, interval):
+        """Returns the change in biomass of a species that does not grow, from dilution over the interval"""
+        dilution = self.config.get("dilution_rate", 0.0)
+        if self.config.get("integrator", "euler") == "exponential":
+            return biomass * np.expm1(-dilution * interval)
+        return -dilution * biomass * interval
+
+    def integrate(self, counts, volume, interval):
+        """Advance the species and its substrates over one interval with the exact solution for fixed fluxes.
+
+        With growth rate mu, dilution rate D and exchange flux v, biomass follows X(t) = X0 exp((mu - D) t) and the
+        exchanged amount is v X0 (exp((mu - D) t) - 1) / (mu - D). A sub-step ends exactly when a substrate is used up,
+        and the fluxes are solved again for the rest of the interval. Once `max_substeps` solves are used, the species
+        is only washed out for the rest of the interval, so substrates are never consumed beyond what is there.
+        Parameters:
+            counts: dict, counts of the reaction_map substrates and of the species at the start of the interval
+            volume: float, environment volume
+            interval: float, time-step
+        Returns:
+            update: dict, change in counts over the interval
+        """
+        name = self.config["name"]
+        dilution = self.config.get("dilution_rate", 0.0)
+        start = dict(counts)
+        counts = dict(counts)
+        remaining = interval
+        for _ in range(self.config.get("max_substeps", 10)):
+            fluxes = self.fluxes_for({key: value / volume for key, value in counts.items()}, remaining)
+            if fluxes is None:
+                break
+            rate = fluxes[0] - dilution
+            biomass = counts[name]
+
+            # length of the sub-step: until the first substrate runs out, at most the rest of the interval
+            step = remaining
+            integral = None
+            exhausted = None
+            for substrate_id, flux in zip(self.config["reaction_map"], fluxes[1:]):
+                if flux < 0 and biomass > 0:
+                    # integral of exp(rate * t) over the sub-step that uses up the substrate
+                    amount = counts[substrate_id] / (-flux * biomass)
+                    used_up = exhaustion_time(rate, amount)
+                    if used_up < step:
+                        step, integral, exhausted = used_up, amount, substrate_id
+            if integral is None:
+                integral = exponential_integral(rate, step)
+
+            for substrate_id, flux in zip(self.config["reaction_map"], fluxes[1:]):
+                counts[substrate_id] += flux * biomass * integral
+            if exhausted is not None:
+                # exactly what was left, without rounding below zero
+                counts[exhausted] = 0.0
+            counts[name] = biomass * np.exp(rate * step)
+            remaining -= step
+            if remaining <= 1e-12 * interval:
+                remaining = 0.0
+                break
+        # no optimal solution or no solves left: the biomass is only washed out for the rest of the interval
+        counts[name] += self.washout(counts[name], remaining)
+        self.time += interval
+        return {key: counts[key] - start[key] for key in start}
+
+    @profiled
     def update(self, inputs, interval):
         current_state = {key:inputs["shared_environment"]["counts"][key] for key, value in self.config["reaction_map"].items()}
         current_state[self.config["name"]] = inputs["shared_environment"]["counts"][self.config["name"]]
         state_update = current_state.copy()
 
-        for substrate_id, reaction_id in self.config["reaction_map"].items():
-            Km, Vmax = self.config["kinetics"][substrate_id]
-            substrate_concentration = inputs["shared_environment"]["concentrations"][substrate_id]
-
-            # calculate Michaelis-Menten flux
-            flux = Vmax * substrate_concentration / (Km + substrate_concentration)
-
-            # use the flux to constrain fba
-            self.model.reactions.get_by_id(reaction_id).lower_bound = -flux
-
-        # solve fba under these constraints
-        solution = self.model.optimize()
-
-        # gather the results
-        ## update biomass
-        biomass_growth_rate = solution.fluxes[self.biomass_identifier]
-        current_biomass = current_state[self.config["name"]]
-        state_update[self.config["name"]] = biomass_growth_rate * current_biomass * interval
+        self.telemetry = {
+            "status": "optimal",
+            "iterations": 0,
+            "solve_time": 0.0,
+            "objective": float("nan"),
+            "warm_start": False,
+            "cache_hit": False,
+            "skipped": False,
+            "surrogate": False,
+            "dormant": False,
+        }
+        biomass_concentration = inputs["shared_environment"]["concentrations"][self.config["name"]]
+        self.dormant = biomass_concentration < self.config.get("dormancy_threshold", 0.0)
+        if self.dormant:
+            # washed out or outcompeted: skip the LP, only washout until the biomass recovers
+            self.telemetry.update(status="dormant", skipped=True, dormant=True)
+            state_update = {key: 0.0 for key in state_update}
+            state_update[self.config["name"]] = self.washout(current_state[self.config["name"]], interval)
+            self.time += interval
+        elif self.config.get("integrator", "euler") == "exponential":
+            state_update = self.integrate(current_state, inputs["shared_environment"]["volume"], interval)
+        else:
+            fluxes = self.fluxes_for(inputs["shared_environment"]["concentrations"], interval)
+            self.time += interval
+
+            # gather the results
+            current_biomass = current_state[self.config["name"]]
+            if fluxes is None:
+                ## no optimal solution, nothing changes apart from washout
+                state_update = {key: 0.0 for key in state_update}
+                state_update[self.config["name"]] = self.washout(current_biomass, interval)
+            else:
+                ## update biomass
+                biomass_growth_rate = fluxes[0] - self.config.get("dilution_rate", 0.0)
+                state_update[self.config["name"]] = biomass_growth_rate * current_biomass * interval
 
-        ## update substrates
-        for substrate_id, reaction_id in self.config["reaction_map"].items():
-            flux = solution.fluxes[reaction_id]
-            state_update[substrate_id] = (flux * current_biomass * interval)
+                ## update substrates
+                for substrate_id, flux in zip(self.config["reaction_map"].keys(), fluxes[1:]):
+                    state_update[substrate_id] = (flux * current_biomass * interval)
 
+        if self.config.get("telemetry"):
+            return {"dfba_update": state_update, "solver_telemetry": self.telemetry}
         return {"dfba_update": state_update}
 
+def exponential_integral(rate, time):
+    """Returns the integral of exp(rate * t) from 0 to time"""
+    if abs(rate * time) < 1e-12:
+        return time
+    return np.expm1(rate * time) / rate
+
+def exhaustion_time(rate, amount):
+    """Returns the time at which the integral of exp(rate * t) reaches amount, or infinity if it never does"""
+    if abs(rate) < 1e-12:
+        return amount
+    argument = 1 + rate * amount
+    if argument <= 0:
+        return np.inf
+    return np.log1p(rate * amount) / rate
+
 class UpdateEnvironment(Step):
     config_schema = {}
 
@@ -130,6 +487,7 @@ class UpdateEnvironment(Step):
             "shared_environment": "volumetric",
         }
 
+    @profiled
     def update(self, inputs):
         species_updates = inputs["species_updates"]
         shared_environment = inputs["shared_environment"]["counts"]
@@ -177,6 +535,7 @@ class StaticConcentration(Process):
             "shared_environment": "volumetric",
         }
 
+    @profiled
     def update(self, inputs, interval):
         shared_environment = inputs["shared_environment"]["counts"]
 
@@ -228,6 +587,7 @@ class WaveFunction(Process):
             "shared_environment": "volumetric",
         }
 
+    @profiled
     def update(self, inputs, interval):
         shared_environment = inputs["shared_environment"]["counts"]
         t = inputs["global_time"]
@@ -278,6 +638,7 @@ class Injector(Process):
             "shared_environment": "volumetric",
         }
 
+    @profiled
     def update(self, inputs, interval):
         tol = 1e-6
         shared_environment = inputs["shared_environment"]["counts"]
@@ -302,6 +663,108 @@ class Injector(Process):
             }
         }
 
+class TimeSeriesConcentration(Process):
+    """The TimeSeriesConcentration process sets the concentration of given substrates to measured time courses, read
+    from a time-series file (see `TimeSeries`) and interpolated at the global time of each time-step
+
+    Config Parameters:
+    -----------
+    path: str, .npy, .csv or .parquet time-series file with one row per time point
+    substrates: list of str, driven substrates, matching the file columns. Required for .npy files (columns after the
+        time column, in order), defaults to all non-time columns otherwise
+    time_column: str, name of the time column of CSV and parquet files (default "time")
+    chunk_size: int, rows read from the file at once (default 10000)
+    """
+    config_schema = {
+        "path": "string",
+        "substrates": "maybe[list[string]]",
+        "time_column": {
+            "_type": "string",
+            "_default": "time",
+        },
+        "chunk_size": {
+            "_type": "integer",
+            "_default": 10000,
+        },
+    }
+
+    def __init__(self, config, core):
+        super().__init__(config, core)
+        self.series = TimeSeries(
+            self.config["path"],
+            columns=self.config.get("substrates"),
+            time_column=self.config.get("time_column", "time"),
+            chunk_size=self.config.get("chunk_size", 10000),
+        )
+
+    def inputs(self):
+        return {
+            "shared_environment": "volumetric",
+            "global_time": "float"
+        }
+
+    def outputs(self):
+        return {
+            "shared_environment": "volumetric",
+        }
+
+    @profiled
+    def update(self, inputs, interval):
+        shared_environment = inputs["shared_environment"]["counts"]
+        volume = inputs["shared_environment"]["volume"]
+        concentrations = self.series.value(inputs["global_time"])
+        update = {}
+        for substrate, concentration in zip(self.series.columns, concentrations):
+            update[substrate] = concentration * volume - shared_environment[substrate]
+
+        return {
+            "shared_environment": {
+                "counts": update
+            }
+        }
+
+class Chemostat(Process):
+    """The Chemostat process feeds and washes out substrates at a fixed dilution rate.
+
+    Over each interval the concentration of every fed substrate relaxes exactly towards its feed concentration,
+    C(t) = C_feed + (C0 - C_feed) exp(-D t). Substrates with a feed concentration of 0 are only washed out. Species
+    biomass is washed out by the `dilution_rate` of each dFBA process, so growth and washout are integrated together.
+    """
+    config_schema = {
+        "dilution_rate": "float",
+        "feed_concentrations": "map[float]",
+    }
+
+    def __init__(self, config, core):
+        super().__init__(config, core)
+
+    def inputs(self):
+        return {
+            "shared_environment": "volumetric",
+        }
+
+    def outputs(self):
+        return {
+            "shared_environment": "volumetric",
+        }
+
+    @profiled
+    def update(self, inputs, interval):
+        volume = inputs["shared_environment"]["volume"]
+        relaxation = np.exp(-self.config["dilution_rate"] * interval)
+
+        update = {}
+        for substrate, feed in self.config["feed_concentrations"].items():
+            current = inputs["shared_environment"]["concentrations"][substrate]
+            target = feed + (current - feed) * relaxation
+            update[substrate] = (target - current) * volume
+
+        return {
+            "shared_environment": {
+                "counts": update
+            }
+        }
+
 #=======
 # TESTS
 #=======
@@ -352,21 +815,19 @@ def get_test_spec():
 
     return spec
 
-@pytest.fixture
-def core():
-    from cdFBA.data_types import register_types
-    # create the core object
-    core = allocate_core()
-    # register data types
-    core = register_types(core)
-    # register all processes and steps
-    core.register_link("dFBA", dFBA)
-    core.register_link("UpdateEnvironment", UpdateEnvironment)
-    core.register_link("StaticConcentration", StaticConcentration)
-    core.register_link("WaveFunction", WaveFunction)
-    core.register_link("Injector", Injector)
-
-    return core
+def get_textbook_test_case():
+    """Returns the dFBA config of E. coli on the textbook model and the inputs of a single update"""
+    from cdFBA.utils import dfba_config
+    config = dfba_config("textbook", name="E.coli", kinetics={"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    inputs = {
+        "shared_environment": {
+            "counts": {"D-Glucose": 10.0, "Acetate": 2.0, "E.coli": 0.5},
+            "concentrations": {"D-Glucose": 5.0, "Acetate": 1.0, "E.coli": 0.25},
+            "volume": 2.0,
+        },
+        "current_update": {},
+    }
+    return config, inputs
 
 def test_environment(core):
     """This tests that the environment runs"""
@@ -439,6 +900,206 @@ def test_injector(core):
     assert results[4]["shared_environment"]["concentrations"]["E.coli"] > results[2]["shared_environment"]["concentrations"]["E.coli"]
     assert results[10]["shared_environment"]["concentrations"]["D-Glucose"]== results[20]["shared_environment"]["concentrations"]["D-Glucose"]
 
+def test_solver_telemetry(core):
+    from cdFBA.utils import SOLVER_TELEMETRY
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1, telemetry=True)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    set_concentration(spec, {"D-Glucose": 2, "Acetate": 0})
+    spec["emitter"] = emitter_from_wires({
+        "global_time": ["global_time"],
+        "solver_telemetry": [SOLVER_TELEMETRY],
+        "shared_environment": [SHARED_ENVIRONMENT],
+    })
+    sim = Composite({"state": spec}, core=core)
+    sim.run(6)
+    results = gather_emitter_results(sim)[("emitter",)]
+
+    telemetry = [result["solver_telemetry"]["E.coli"] for result in results]
+    biomass = [result["shared_environment"]["counts"]["E.coli"] for result in results]
+    assert telemetry[1]["status"] == "optimal"
+    assert telemetry[1]["objective"] > 0 and telemetry[1]["solve_time"] > 0
+    assert not telemetry[1]["warm_start"] and telemetry[2]["warm_start"]
+    # once the substrates run out the LP is infeasible and the species stops changing
+    infeasible = [step for step in range(1, len(results)) if telemetry[step]["status"] != "optimal"]
+    assert infeasible
+    for step in infeasible:
+        assert biomass[step] == biomass[step - 1]
+    assert all(result["shared_environment"]["counts"]["D-Glucose"] >= 0 for result in results)
+
+def test_multirate(core):
+    def run(multirate):
+        spec = make_cdfba_composite({"fast": "textbook", "slow": "textbook"}, medium_type=None,
+                                    exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1, interval=0.1, multirate=multirate)
+        set_kinetics("fast", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+        set_kinetics("slow", spec, {"D-Glucose": (0.02, 2), "Acetate": (0.5, 0.5)})
+        set_concentration(spec, {"D-Glucose": 20, "Acetate": 0})
+        sim = Composite({"state": spec}, core=core)
+        sim.run(3)
+        solves = {name: sim.state["Species"][name]["instance"].solves for name in ("fast", "slow")}
+        return sim.state[SHARED_ENVIRONMENT]["counts"], solves
+
+    reference, reference_solves = run(None)
+    counts, solves = run({"growth_tolerance": 0.05, "max_interval": 1.0, "bound_tolerance": 0.05})
+
+    # the slow species and both species after the glucose runs out solve less often
+    assert solves["slow"] < solves["fast"] < reference_solves["fast"]
+    assert sum(solves.values()) < sum(reference_solves.values()) / 2
+    for key, value in reference.items():
+        assert isclose(counts[key], value, rel_tol=0.01, abs_tol=1e-6)
+
+def test_exponential_integrator(core):
+    def run(integrator, interval, duration=4.0):
+        spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"],
+                                    volume=1, interval=interval)
+        set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+        set_concentration(spec, {"D-Glucose": 20, "Acetate": 0, "E.coli": 0.1})
+        spec["Species"]["E.coli"]["config"]["integrator"] = integrator
+        sim = Composite({"state": spec}, core=core)
+        sim.run(duration)
+        return sim.state[SHARED_ENVIRONMENT]["counts"]
+
+    reference = run("euler", 0.01)
+    euler = run("euler", 0.5)
+    exponential = run("exponential", 0.5)
+    # the glucose runs out during the run, and the exponential integrator stops exactly when it does
+    assert isclose(exponential["D-Glucose"], 0, abs_tol=1e-9)
+    euler_error = abs(euler["E.coli"] - reference["E.coli"])
+    exponential_error = abs(exponential["E.coli"] - reference["E.coli"])
+    assert exponential_error < euler_error / 5
+
+    # with a single solve per interval the species stops growing when the glucose runs out, so the substrates
+    # consumed and produced match the biomass made at the solved yields, and the process time moves by one interval
+    config, _ = get_textbook_test_case()
+    process = dFBA(dict(config, integrator="exponential", max_substeps=1), core)
+    counts = {"D-Glucose": 1.0, "Acetate": 0.0, "E.coli": 0.5}
+    inputs = {"shared_environment": {"counts": counts, "concentrations": counts, "volume": 1.0}, "current_update": {}}
+    update = process.update(inputs, 2.0)["dfba_update"]
+    assert update["D-Glucose"] == -1.0 and process.time == 2.0
+    fluxes = process.fluxes_for(counts, 2.0)
+    for substrate_id, flux in zip(process.config["reaction_map"], fluxes[1:]):
+        assert isclose(update[substrate_id] * fluxes[0], update["E.coli"] * flux, abs_tol=1e-12)
+
+def test_chemostat(core):
+    chemostat = Chemostat({"dilution_rate": 0.2, "feed_concentrations": {"D-Glucose": 10.0, "Acetate": 0.0}}, core)
+    environment = {"counts": {"D-Glucose": 4.0, "Acetate": 6.0}, "concentrations": {"D-Glucose": 2.0, "Acetate": 3.0}, "volume": 2.0}
+    update = chemostat.update({"shared_environment": environment}, 1.5)["shared_environment"]["counts"]
+    assert isclose(update["D-Glucose"], (10 + (2 - 10) * np.exp(-0.3) - 2) * 2)
+    assert isclose(update["Acetate"], (3 * np.exp(-0.3) - 3) * 2)
+
+    # two half steps give the same result as one step
+    half = chemostat.update({"shared_environment": environment}, 0.75)["shared_environment"]["counts"]
+    middle = {key: environment["counts"][key] + half[key] for key in half}
+    middle = {"counts": middle, "concentrations": {key: value / 2.0 for key, value in middle.items()}, "volume": 2.0}
+    second = chemostat.update({"shared_environment": middle}, 0.75)["shared_environment"]["counts"]
+    assert isclose(half["D-Glucose"] + second["D-Glucose"], update["D-Glucose"])
+
+    # species without an optimal solution are still washed out
+    config, _ = get_textbook_test_case()
+    config = dict(config, dilution_rate=0.2)
+    counts = {"D-Glucose": 0.0, "Acetate": 0.0, "E.coli": 0.5}
+    inputs = {"shared_environment": {"counts": counts, "concentrations": counts, "volume": 1.0}, "current_update": {}}
+    assert isclose(dFBA(config, core).update(inputs, 1.5)["dfba_update"]["E.coli"], -0.2 * 0.5 * 1.5)
+    exponential = dFBA(dict(config, integrator="exponential"), core).update(inputs, 1.5)["dfba_update"]
+    assert isclose(exponential["E.coli"], 0.5 * (np.exp(-0.3) - 1))
+
+def test_dormancy(core):
+    from cdFBA.utils import set_dormancy, get_dormant_species, SPECIES_STORE
+    from cdFBA.processes.dfbalauncher import get_env_monitor_spec
+    config, _ = get_textbook_test_case()
+    kinetics = config["kinetics"]
+    process = dFBA(dict(config, dormancy_threshold=1e-6), core)
+    counts = {"D-Glucose": 10.0, "Acetate": 0.0, "E.coli": 1e-7}
+    inputs = {"shared_environment": {"counts": counts, "concentrations": counts, "volume": 1.0}, "current_update": {}}
+    assert process.update(inputs, 1.0)["dfba_update"] == {"D-Glucose": 0.0, "Acetate": 0.0, "E.coli": 0.0}
+    assert process.dormant and process.solves == 0
+    # an injection above the threshold wakes the species up
+    counts["E.coli"] = 0.5
+    assert process.update(inputs, 1.0)["dfba_update"]["E.coli"] > 0
+    assert not process.dormant and process.solves == 1
+
+    # dormant biomass is still washed out of a chemostat
+    counts["E.coli"] = 1e-7
+    for integrator, washout in (("euler", -0.2 * 1e-7 * 1.5), ("exponential", 1e-7 * np.expm1(-0.3))):
+        options = dict(config, dormancy_threshold=1e-6, dilution_rate=0.2, integrator=integrator)
+        update = dFBA(options, core).update(inputs, 1.5)["dfba_update"]
+        assert isclose(update["E.coli"], washout) and update["D-Glucose"] == 0.0
+
+    spec = make_cdfba_composite({"A": "textbook", "B": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1)
+    for species in ("A", "B"):
+        set_kinetics(species, spec, kinetics)
+    set_concentration(spec, {"D-Glucose": 10, "Acetate": 0, "A": 0.5, "B": 1e-7})
+    set_dormancy(spec, 1e-6)
+    sim = Composite({"state": spec}, core=core)
+    sim.run(1)
+    assert get_dormant_species(sim.state) == ["B"]
+    assert sim.state[SHARED_ENVIRONMENT]["counts"]["B"] == 1e-7
+
+    # with removal, the EnvironmentMonitor drops the dormant species from the composite
+    set_dormancy(spec, 1e-6, species=["B"], remove=True)
+    spec["monitor"] = get_env_monitor_spec(1.0)
+    sim = Composite({"state": spec}, core=core)
+    sim.run(1)
+    assert list(sim.state[SPECIES_STORE]) == ["A"]
+    assert "B" not in sim.state[SHARED_ENVIRONMENT]["counts"]
+
+def test_share_solves(core):
+    import copy
+    from cdFBA.utils import SOLVER_TELEMETRY, SPECIES_STORE
+    model_dict = {"A": "textbook", "B": "textbook", "C": "textbook"}
+    results = {}
+    for share_solves in (False, True):
+        spec = make_cdfba_composite(model_dict, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1,
+                                    telemetry=True, share_solves=share_solves)
+        for species in model_dict:
+            set_kinetics(species, spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+        # C takes up glucose faster, so its LP differs
+        set_kinetics("C", spec, {"D-Glucose": (0.02, 10)})
+        set_concentration(spec, {"D-Glucose": 10, "Acetate": 0})
+        sim = Composite({"state": spec}, core=core)
+        hits = 0
+        for _ in range(3):
+            sim.run(1)
+            hits += sum(sim.state[SOLVER_TELEMETRY][species]["cache_hit"] for species in model_dict)
+        solves = {species: sim.state[SPECIES_STORE][species]["instance"].solves for species in model_dict}
+        results[share_solves] = (dict(sim.state[SHARED_ENVIRONMENT]["counts"]), hits, solves)
+
+    counts, hits, solves = results[False]
+    shared_counts, shared_hits, shared_solves = results[True]
+    for key, value in counts.items():
+        assert isclose(shared_counts[key], value)
+    # B reuses A's solve every step, C only once glucose runs out and its bounds match
+    assert hits == 0 and shared_hits >= 3
+    assert min(shared_solves["A"], shared_solves["B"]) == 0
+    assert sum(shared_solves.values()) == sum(solves.values()) - shared_hits
+
+    # solves are only shared within a composite, not with another one at the same time and environment
+    spec = make_cdfba_composite({"A": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1,
+                                telemetry=True, share_solves=True)
+    set_kinetics("A", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    for _ in range(2):
+        sim = Composite({"state": copy.deepcopy(spec)}, core=core)
+        sim.run(1)
+        assert not sim.state[SOLVER_TELEMETRY]["A"]["cache_hit"]
+        assert sim.state[SPECIES_STORE]["A"]["instance"].solves == 1
+
+def test_timeseries_concentration(core, tmp_path):
+    times = np.arange(0, 11, 0.5)
+    pd.DataFrame({"time": times, "D-Glucose": 5 + times, "unused": times}).to_csv(tmp_path / "glucose.csv", index=False)
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=2)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    spec["measured"] = get_timeseries_spec({"path": str(tmp_path / "glucose.csv"), "substrates": ["D-Glucose"], "chunk_size": 4})
+    spec["emitter"] = emitter_from_wires({
+        "global_time": ["global_time"],
+        "shared_environment": [SHARED_ENVIRONMENT],
+    })
+    sim = Composite({"state": spec}, core=core)
+    sim.run(5)
+    results = gather_emitter_results(sim)[("emitter",)]
+    # each step sets the glucose concentration measured at its start
+    for result in results[1:]:
+        assert isclose(result["shared_environment"]["concentrations"]["D-Glucose"], 5 + result["global_time"] - 1)
+    assert results[-1]["shared_environment"]["concentrations"]["E.coli"] > results[0]["shared_environment"]["concentrations"]["E.coli"]
+
 if __name__ == "__main__":
     from cdFBA.data_types import register_types
 
@@ -1,13 +1,16 @@
 import pprint
+import numpy as np
 
 from process_bigraph import  Process, Step, Composite, allocate_core
 from process_bigraph.emitter import gather_emitter_results, emitter_from_wires
 
-from cdFBA.utils import SHARED_ENVIRONMENT, SPECIES_STORE, THRESHOLDS, DFBA_RESULTS
+from cdFBA.utils import SHARED_ENVIRONMENT, SPECIES_STORE, THRESHOLDS, DFBA_RESULTS, CONVERGENCE
 from cdFBA.utils import get_single_dfba_spec, set_concentration, make_cdfba_composite, set_kinetics
+from cdFBA.utils import get_environment_emitter_spec
 from cdFBA.processes.dfba import dFBA, UpdateEnvironment
+from cdFBA.processes.emitters import EnvironmentEmitter, flush_chunked_emitters
+from cdFBA.profiling import profiled
 
-from matplotlib import pyplot as plt
 
 class EnvironmentMonitor(Step):
     """
@@ -34,6 +37,7 @@ class EnvironmentMonitor(Step):
             "dfba_results": "map",
         }
 
+    @profiled
     def update(self, inputs):
 
         to_add = {}
@@ -47,10 +51,14 @@ class EnvironmentMonitor(Step):
 
         for threshold in inputs["thresholds"].values():
             substrate = threshold["substrate"]
-            if ((isinstance(threshold["range"]["upper"], (float, int))
-                and inputs["shared_environment"]["concentrations"][substrate] > threshold["range"]["upper"])
-                    or (isinstance(threshold["range"]["lower"], (float, int))
-                        and inputs["shared_environment"]["concentrations"][substrate] < threshold["range"]["lower"])):
+            # unset range ends are missing from the state
+            upper, lower = threshold["range"].get("upper"), threshold["range"].get("lower")
+            if substrate not in inputs["shared_environment"]["concentrations"]:
+                continue
+            if ((isinstance(upper, (float, int))
+                and inputs["shared_environment"]["concentrations"][substrate] > upper)
+                    or (isinstance(lower, (float, int))
+                        and inputs["shared_environment"]["concentrations"][substrate] < lower)):
                 name = threshold["name"]
                 parent = threshold["parent"]
                 mass = threshold["mass"]
@@ -95,6 +103,131 @@ class EnvironmentMonitor(Step):
 
         return update
 
+class ConvergenceMonitor(Step):
+    """
+    Detects when a run has nothing left to simulate and records why in the Convergence store. The criteria are checked
+    in this order, and the first one met is latched:
+        "substrates exhausted"  every substrate concentration is below `substrate_floor`
+        "no growth"             every species grew at a specific rate below `growth_tolerance` in magnitude over the
+                                last `window` time steps
+        "steady state"          no count changed by more than `relative_change` (relative) over the last `window` time
+                                steps
+    Criteria without a tolerance are not checked. Use `run_until_converged` to stop the run once one is met.
+
+    Config Parameters:
+    -----------
+    window: int, number of time steps the growth and steady state criteria must hold for
+    relative_change: float, largest relative change of any count over the window at a steady state
+    growth_tolerance: float, largest magnitude of the specific growth rate of any species over the window
+    substrate_floor: float, concentration below which a substrate counts as exhausted
+    """
+    config_schema = {
+        "window": {
+            "_type": "integer",
+            "_default": 5,
+        },
+        "relative_change": "maybe[float]",
+        "growth_tolerance": "maybe[float]",
+        "substrate_floor": "maybe[float]",
+    }
+
+    def __init__(self, config, core):
+        super().__init__(config, core)
+        self.times = []
+        self.history = []
+        self.reason = None
+
+    def inputs(self):
+        return {
+            "global_time": "float",
+            "shared_environment": "volumetric",
+            "dfba_results": "map",  # keyed by the species in the composite
+        }
+
+    def outputs(self):
+        return {
+            "convergence": "convergence",
+        }
+
+    def check(self, species, concentrations):
+        """Returns the first criterion met by the current history and concentrations, or None"""
+        floor = self.config.get("substrate_floor")
+        if floor is not None:
+            substrates = [value for key, value in concentrations.items() if key not in species]
+            if substrates and all(value < floor for value in substrates):
+                return "substrates exhausted"
+
+        if len(self.history) <= self.config["window"]:
+            return None
+        start, end = self.history[0], self.history[-1]
+        keys = [key for key in end if key in start]
+
+        growth_tolerance = self.config.get("growth_tolerance")
+        if growth_tolerance is not None and species:
+            elapsed = self.times[-1] - self.times[0]
+            rates = [
+                np.log(end[name] / start[name]) / elapsed if start[name] > 0 and end[name] > 0 else 0.0
+                for name in species if name in start and name in end
+            ]
+            if all(abs(rate) < growth_tolerance for rate in rates):
+                return "no growth"
+
+        relative_change = self.config.get("relative_change")
+        if relative_change is not None and keys:
+            if all(abs(end[key] - start[key]) <= relative_change * max(abs(start[key]), abs(end[key]), 1e-12)
+                   for key in keys):
+                return "steady state"
+        return None
+
+    @profiled
+    def update(self, inputs):
+        if self.reason is not None:
+            return {}
+
+        time = inputs["global_time"]
+        counts = dict(inputs["shared_environment"]["counts"])
+        # steps can run several times per time step, keep the latest counts of each
+        if self.times and self.times[-1] == time:
+            self.history[-1] = counts
+        else:
+            self.times.append(time)
+            self.history.append(counts)
+            if len(self.history) > self.config["window"] + 1:
+                self.times.pop(0)
+                self.history.pop(0)
+
+        reason = self.check(set(inputs["dfba_results"].keys()), inputs["shared_environment"]["concentrations"])
+        if reason is None:
+            return {}
+        self.reason = reason
+        return {
+            "convergence": {
+                "converged": True,
+                "reason": reason,
+                "time": time,
+            }
+        }
+
+def run_until_converged(sim, duration, every=1.0):
+    """Run a composite with a ConvergenceMonitor until it converges or the duration is reached. ChunkedEmitters are
+    flushed when the run stops
+    Parameters:
+        sim: Composite, cdFBA composite with a ConvergenceMonitor step (see `get_convergence_monitor_spec`)
+        duration: float, longest time to run
+        every: float, simulated time between convergence checks
+    Returns:
+        reason: str, criterion that stopped the run, or None if it ran for the full duration
+    """
+    end = sim.state["global_time"] + duration
+    reason = None
+    while sim.state["global_time"] < end:
+        sim.run(min(every, end - sim.state["global_time"]))
+        if sim.state.get(CONVERGENCE, {}).get("converged"):
+            reason = sim.state[CONVERGENCE]["reason"]
+            break
+    flush_chunked_emitters(sim)
+    return reason
+
 def get_env_monitor_spec(interval):
     """Returns a specification dictionary for the environment monitor"""
     return {
@@ -115,6 +248,7 @@ def get_env_monitor_spec(interval):
     }
 
 def run_env_monitor(core):
+    from matplotlib import pyplot as plt
     # BiGG model ids or the path name to the associated model file
     model_dict = {
         "E.coli": "iAF1260",
@@ -169,10 +303,7 @@ def run_env_monitor(core):
         set_kinetics(species, spec, kinetics)
 
     # set emitter specs
-    spec["emitter"] = emitter_from_wires({
-        "global_time": ["global_time"],
-        "shared_environment": [SHARED_ENVIRONMENT],
-    })
+    spec["emitter"] = get_environment_emitter_spec()
     pprint.pprint(spec)
 
     # put it in a composite
@@ -186,34 +317,13 @@ def run_env_monitor(core):
 
     # run the simulation
     sim.run(40)
-    results = gather_emitter_results(sim)[("emitter",)]
-
-    # print the results
-    timepoints = []
-    for timepoint in results:
-        time = timepoint.pop("global_time")
-        timepoints.append(time)
-        # dfba_spec = timepoint.pop(name1)
-        print(f"TIME: {time}")
-        print(f"STATE: {timepoint}")
-
-    env = [timepoint["shared_environment"]["concentrations"] for timepoint in results]
-    env_combined = {}
-    for d in env:
-        for key, value in d.items():
-            if key not in env_combined:
-                env_combined[key] = []
-            env_combined[key].append(value)
+    # species added mid-run are NaN before they appear, so all columns share the time axis
+    concentrations = sim.state["emitter"]["instance"].to_dataframe("concentrations")
+    print(concentrations)
 
     fig, ax = plt.subplots(dpi=300)
-    for key, value in env_combined.items():
-        length_diff = len(timepoints) - len(value)
-        if length_diff > 0:
-            # Align the data to the end of the timepoints
-            aligned_timepoints = timepoints[length_diff:]
-        else:
-            aligned_timepoints = timepoints
-        ax.plot(aligned_timepoints, value, label=key)
+    for key in concentrations.columns:
+        ax.plot(concentrations.index, concentrations[key], label=key)
     plt.xlabel("Time")
     plt.ylabel("Substrate Concentration")
     plt.legend()
@@ -222,6 +332,45 @@ def run_env_monitor(core):
 
     pprint.pprint(sim.state)
 
+#=======
+# TESTS
+#=======
+
+def test_convergence_monitor(core):
+    import copy
+    from cdFBA.utils import get_convergence_monitor_spec
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    set_concentration(spec, {"D-Glucose": 10, "Acetate": 0})
+
+    # glucose and then the acetate made from it run out well before the end of the run
+    exhaustion = copy.deepcopy(spec)
+    exhaustion["monitor"] = get_convergence_monitor_spec({"substrate_floor": 1e-3})
+    sim = Composite({"state": exhaustion}, core=core)
+    assert run_until_converged(sim, 50) == "substrates exhausted"
+    assert sim.state[CONVERGENCE]["converged"]
+    assert sim.state[CONVERGENCE]["time"] == sim.state["global_time"] < 50
+    assert all(value < 1e-3 for key, value in sim.state[SHARED_ENVIRONMENT]["concentrations"].items() if key != "E.coli")
+
+    # without a floor, the flat tail after exhaustion is detected over the window
+    flat = copy.deepcopy(spec)
+    flat["monitor"] = get_convergence_monitor_spec({"window": 3, "growth_tolerance": 1e-4, "relative_change": 1e-6})
+    sim = Composite({"state": flat}, core=core)
+    assert run_until_converged(sim, 50) == "no growth"
+    stopped = sim.state["global_time"]
+    assert stopped < 50
+    reference = Composite({"state": copy.deepcopy(spec)}, core=core)
+    reference.run(stopped - 3)
+    assert np.isclose(reference.state[SHARED_ENVIRONMENT]["counts"]["E.coli"],
+                      sim.state[SHARED_ENVIRONMENT]["counts"]["E.coli"], rtol=1e-4)
+
+    # a run that never converges goes on for the full duration
+    growing = copy.deepcopy(spec)
+    growing["monitor"] = get_convergence_monitor_spec({"growth_tolerance": 1e-4})
+    sim = Composite({"state": growing}, core=core)
+    assert run_until_converged(sim, 2) is None
+    assert sim.state["global_time"] == 2 and not sim.state[CONVERGENCE]["converged"]
+
 if __name__ == "__main__":
     from cdFBA.data_types import register_types
 
@@ -233,5 +382,6 @@ if __name__ == "__main__":
     core.register_link('dFBA', dFBA)
     core.register_link('UpdateEnvironment', UpdateEnvironment)
     core.register_link('EnvironmentMonitor', EnvironmentMonitor)
+    core.register_link('EnvironmentEmitter', EnvironmentEmitter)
 
     run_env_monitor(core)
@@ -0,0 +1,547 @@
+import os
+import json
+import queue
+import warnings
+import threading
+import numpy as np
+import pandas as pd
+
+from process_bigraph import Composite, allocate_core
+from process_bigraph.emitter import Emitter, gather_emitter_results
+
+from cdFBA.utils import SHARED_ENVIRONMENT, make_cdfba_composite, set_kinetics, set_concentration
+from cdFBA.utils import get_environment_emitter_spec, get_chunked_emitter_spec
+from cdFBA.profiling import profiled
+
+
+class ColumnStore:
+    """Preallocated float columns sharing one time axis
+
+    Rows are timepoints and columns are added the first time a key is seen, so columns that appear partway
+    through a run are NaN before they first appear (and after they disappear). Storage grows by doubling.
+
+    Parameters:
+    -----------
+    capacity: int, number of timepoints to preallocate
+    """
+    def __init__(self, capacity=1024):
+        self.index = {}
+        self.time = np.empty(capacity)
+        self.data = np.full((capacity, 8), np.nan)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def keys(self):
+        return list(self.index)
+
+    def _grow(self, rows, columns):
+        capacity, width = self.data.shape
+        if rows <= capacity and columns <= width:
+            return
+        while rows > capacity:
+            capacity *= 2
+        while columns > width:
+            width *= 2
+        data = np.full((capacity, width), np.nan)
+        data[:self.length, :self.data.shape[1]] = self.data[:self.length]
+        time = np.empty(capacity)
+        time[:self.length] = self.time[:self.length]
+        self.data, self.time = data, time
+
+    def append(self, time, values):
+        """Record one timepoint
+        Parameters:
+            time: float, global time of the timepoint
+            values: dict, column names as keys and values as values
+        """
+        for key in values:
+            if key not in self.index:
+                self.index[key] = len(self.index)
+        self._grow(self.length + 1, len(self.index))
+        row = self.data[self.length]
+        for key, value in values.items():
+            row[self.index[key]] = value
+        self.time[self.length] = time
+        self.length += 1
+
+    def column(self, key):
+        """Returns a view of the recorded values of one column"""
+        return self.data[:self.length, self.index[key]]
+
+    def columns(self):
+        """Returns views of all recorded columns"""
+        return {key: self.data[:self.length, index] for key, index in self.index.items()}
+
+    def to_dataframe(self):
+        """Returns the recorded columns as a DataFrame indexed by time, backed by the column storage (no copy)"""
+        return pd.DataFrame(
+            self.data[:self.length, :len(self.index)],
+            index=pd.Index(self.time[:self.length], name="global_time", copy=False),
+            columns=self.keys,
+            copy=False,
+        )
+
+
+class EnvironmentEmitter(Emitter):
+    """Records the counts, concentrations and volume of the Shared Environment into NumPy columns
+
+    There is one column for every substrate and species and a shared time axis. Species added partway through
+    a run are NaN before they appear. Use `to_dataframe` for analysis.
+
+    Config Parameters:
+    -----------
+    capacity: int, number of timepoints to preallocate (grows as needed)
+    subsample: int, record every Nth update
+    """
+    config_schema = {
+        "capacity": {"_type": "integer", "_default": 1024},
+        "subsample": {"_type": "integer", "_default": 1},
+    }
+
+    def __init__(self, config, core):
+        super().__init__(config, core)
+        self.counts = ColumnStore(self.config["capacity"])
+        self.concentrations = ColumnStore(self.config["capacity"])
+        self.volume = ColumnStore(self.config["capacity"])
+        self._updates = 0
+
+    def inputs(self):
+        return {
+            "global_time": "float",
+            "shared_environment": "volumetric",
+        }
+
+    @profiled
+    def update(self, inputs):
+        self._updates += 1
+        if (self._updates - 1) % self.config["subsample"] != 0:
+            return {}
+        time = inputs["global_time"]
+        environment = inputs["shared_environment"]
+        self.counts.append(time, environment["counts"])
+        self.concentrations.append(time, environment["concentrations"])
+        self.volume.append(time, {"volume": environment["volume"]})
+        return {}
+
+    def to_dataframe(self, kind="concentrations"):
+        """Returns the recorded trajectories as a DataFrame without copying
+        Parameters:
+            kind: str, "counts", "concentrations" or "volume"
+        """
+        return getattr(self, kind).to_dataframe()
+
+    def query(self, paths=None, query=None):
+        """Returns the recorded columns as views
+        Returns:
+            dict with "global_time" (array), "counts" and "concentrations" (dicts of arrays) and "volume" (array)
+        """
+        return {
+            "global_time": self.concentrations.time[:len(self.concentrations)],
+            "counts": self.counts.columns(),
+            "concentrations": self.concentrations.columns(),
+            "volume": self.volume.column("volume") if len(self.volume) else np.empty(0),
+        }
+
+class ChunkedEmitter(Emitter):
+    """Streams Shared Environment (and optionally dFBA Results) trajectories to chunked files on local disk
+
+    Timepoints are buffered in column stores of `chunk_size` rows. Full chunks are written by a background thread
+    as one .npy file per group (time, counts, concentrations, volume, dfba_results), and the manifest is replaced
+    atomically after every chunk, so the output can be read with `ChunkedTrajectory` while the run is in progress.
+    At most `max_pending` chunks wait for the writer, so memory stays bounded however long the run is.
+    `Composite.run` does not tell the emitter when the run ends, so call `flush` (or `close`, or
+    `flush_chunked_emitters` on the composite) after the run to write the last partial chunk. `run_until_converged`,
+    `run_with_checkpoints` and `gather_emitter_results` do this for you.
+
+    Config Parameters:
+    -----------
+    path: str, output directory
+    chunk_size: int, number of timepoints per chunk
+    max_pending: int, maximum number of full chunks waiting to be written
+    dfba_results: bool, whether to record the dFBA Results store (wire the "dfba_results" input)
+    """
+    config_schema = {
+        "path": {"_type": "string", "_default": "out/trajectory"},
+        "chunk_size": {"_type": "integer", "_default": 10000},
+        "max_pending": {"_type": "integer", "_default": 2},
+        "dfba_results": {"_type": "boolean", "_default": False},
+    }
+
+    def __init__(self, config, core):
+        super().__init__(config, core)
+        self.path = self.config["path"]
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest = {"groups": ["counts", "concentrations", "volume"], "chunks": []}
+        if self.config["dfba_results"]:
+            self.manifest["groups"].append("dfba_results")
+        self._buffer = self._new_buffer()
+        self._queue = queue.Queue(maxsize=max(self.config["max_pending"], 1))
+        self._error = None
+        self._writer = threading.Thread(target=self._write_chunks, daemon=True)
+        self._writer.start()
+
+    def inputs(self):
+        ports = {
+            "global_time": "float",
+            "shared_environment": "volumetric",
+        }
+        if self.config["dfba_results"]:
+            ports["dfba_results"] = "map[map[overwrite[float]]]"
+        return ports
+
+    def _new_buffer(self):
+        return {group: ColumnStore(self.config["chunk_size"]) for group in self.manifest["groups"]}
+
+    @profiled
+    def update(self, inputs):
+        time = inputs["global_time"]
+        environment = inputs["shared_environment"]
+        self._buffer["counts"].append(time, environment["counts"])
+        self._buffer["concentrations"].append(time, environment["concentrations"])
+        self._buffer["volume"].append(time, {"volume": environment["volume"]})
+        if self.config["dfba_results"]:
+            self._buffer["dfba_results"].append(time, {
+                f"{species}/{key}": value
+                for species, update in inputs["dfba_results"].items()
+                for key, value in update.items()
+            })
+        if len(self._buffer["counts"]) >= self.config["chunk_size"]:
+            self._submit()
+        return {}
+
+    def _submit(self):
+        if self._error is not None:
+            raise RuntimeError(f"ChunkedEmitter failed to write to {self.path}") from self._error
+        if len(self._buffer["counts"]) == 0:
+            return
+        self._queue.put(self._buffer)  # blocks while max_pending chunks are waiting
+        self._buffer = self._new_buffer()
+
+    def _write_chunks(self):
+        while True:
+            buffer = self._queue.get()
+            try:
+                if buffer is None:
+                    return
+                self._write_chunk(buffer)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write_chunk(self, buffer):
+        number = len(self.manifest["chunks"])
+        length = len(buffer["counts"])
+        chunk = {"length": length, "time": f"chunk_{number:06d}_time.npy", "columns": {}, "files": {}}
+        np.save(os.path.join(self.path, chunk["time"]), buffer["counts"].time[:length])
+        for group, store in buffer.items():
+            chunk["files"][group] = f"chunk_{number:06d}_{group}.npy"
+            chunk["columns"][group] = store.keys
+            np.save(os.path.join(self.path, chunk["files"][group]), store.data[:length, :len(store.index)])
+        self.manifest["chunks"].append(chunk)
+        temporary = os.path.join(self.path, "manifest.json.tmp")
+        with open(temporary, "w") as file:
+            json.dump(self.manifest, file)
+        os.replace(temporary, os.path.join(self.path, "manifest.json"))
+
+    def flush(self):
+        """Write all buffered timepoints and wait until they are on disk"""
+        self._submit()
+        self._queue.join()
+        if self._error is not None:
+            raise RuntimeError(f"ChunkedEmitter failed to write to {self.path}") from self._error
+
+    def close(self):
+        """Flush and stop the writer thread"""
+        if self._writer.is_alive():
+            self.flush()
+            self._queue.put(None)
+            self._writer.join()
+
+    def query(self, paths=None, query=None):
+        """Flushes the buffer and returns a `ChunkedTrajectory` reader of the output directory"""
+        self.flush()
+        return ChunkedTrajectory(self.path)
+
+
+def flush_chunked_emitters(sim):
+    """Write the buffered timepoints of every ChunkedEmitter of a composite to disk
+    Parameters:
+        sim: Composite
+    """
+    for node in sim.step_paths.values():
+        if isinstance(node.get("instance"), ChunkedEmitter):
+            node["instance"].flush()
+
+
+class ChunkedTrajectory:
+    """Reads the output of a `ChunkedEmitter`, also while the run is still writing it
+
+    Chunks are opened memory-mapped, so only the columns that are read are loaded.
+
+    Parameters:
+    -----------
+    path: str, output directory of a ChunkedEmitter
+    """
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        """Reload the manifest to see chunks written since the reader was opened"""
+        manifest_path = os.path.join(self.path, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = {"groups": [], "chunks": []}
+
+    def __len__(self):
+        return sum(chunk["length"] for chunk in self.manifest["chunks"])
+
+    def chunks(self, group):
+        """Yields (time, columns, data) for every chunk of a group, with time and data memory-mapped"""
+        for chunk in self.manifest["chunks"]:
+            time = np.load(os.path.join(self.path, chunk["time"]), mmap_mode="r")
+            data = np.load(os.path.join(self.path, chunk["files"][group]), mmap_mode="r")
+            yield time, chunk["columns"][group], data
+
+    def time(self):
+        """Returns the time axis of all chunks"""
+        times = [time for time, _, _ in self.chunks(self.manifest["groups"][0])] if self.manifest["chunks"] else []
+        return np.concatenate(times) if times else np.empty(0)
+
+    def columns(self, group):
+        """Returns the names of all columns recorded in a group"""
+        names = {}
+        for chunk in self.manifest["chunks"]:
+            names.update(dict.fromkeys(chunk["columns"][group]))
+        return list(names)
+
+    def read(self, group="concentrations", columns=None):
+        """Returns a group as a DataFrame indexed by time. Columns missing from a chunk are NaN
+        Parameters:
+            group: str, "counts", "concentrations", "volume" or "dfba_results"
+            columns: list of str, columns to read (all if None)
+        """
+        columns = self.columns(group) if columns is None else list(columns)
+        data = np.full((len(self), len(columns)), np.nan)
+        times = np.empty(len(self))
+        row = 0
+        for time, names, chunk in self.chunks(group):
+            position = {name: index for index, name in enumerate(names)}
+            for column, name in enumerate(columns):
+                if name in position:
+                    data[row:row + len(time), column] = chunk[:, position[name]]
+            times[row:row + len(time)] = time
+            row += len(time)
+        return pd.DataFrame(data, index=pd.Index(times, name="global_time"), columns=columns, copy=False)
+
+class FluxRecorder:
+    """Writes the full flux vector of one species every step into a preallocated memory-mapped float32 array
+
+    The dense trajectory is a (steps, reactions) .npy file, with the reaction IDs and the number of recorded steps in
+    "reactions.json". With `sparse_threshold` set, fluxes with an absolute value at or below it are dropped and the
+    trajectory is stored in CSR form instead (indptr.npy, indices.bin, values.bin). Every recorded step is written
+    through to the files, so `load_flux_trajectory` can read the trajectory during and after a run. `close` releases
+    the files, and dFBA calls it when the process is torn down.
+
+    Parameters:
+    -----------
+    path: str, output directory
+    reaction_ids: list of str, reaction IDs in flux vector order
+    steps: int, number of (recorded) timesteps to preallocate
+    decimation: int, record every Nth step
+    sparse_threshold: float, store fluxes sparsely, dropping those with |flux| <= threshold. Dense if None
+    """
+    def __init__(self, path, reaction_ids, steps, decimation=1, sparse_threshold=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.steps = int(steps)
+        self.decimation = max(int(decimation), 1)
+        self.sparse_threshold = sparse_threshold
+        self.length = 0
+        self._calls = 0
+        self._index = {"reactions": list(reaction_ids), "decimation": self.decimation,
+                       "sparse": sparse_threshold is not None, "length": 0}
+        self._write_index()
+        self.time = np.lib.format.open_memmap(os.path.join(path, "time.npy"), mode="w+", dtype=np.float64,
+                                              shape=(self.steps,))
+        if sparse_threshold is None:
+            self.fluxes = np.lib.format.open_memmap(os.path.join(path, "fluxes.npy"), mode="w+", dtype=np.float32,
+                                                    shape=(self.steps, len(reaction_ids)))
+        else:
+            self.indptr = np.lib.format.open_memmap(os.path.join(path, "indptr.npy"), mode="w+", dtype=np.int64,
+                                                    shape=(self.steps + 1,))
+            self._indices = open(os.path.join(path, "indices.bin"), "wb")
+            self._values = open(os.path.join(path, "values.bin"), "wb")
+
+    def record(self, time, fluxes):
+        """Record the flux vector of one step (skipped unless it falls on the decimation)
+        Parameters:
+            time: float, time of the step
+            fluxes: np.ndarray, flux vector in `reaction_ids` order
+        """
+        self._calls += 1
+        if (self._calls - 1) % self.decimation != 0:
+            return
+        if self.length >= self.steps:
+            if self.length == self.steps:
+                warnings.warn(f"FluxRecorder at {self.path} is full after {self.steps} steps, stopped recording")
+                self.length += 1
+            return
+        self.time[self.length] = time
+        if self.sparse_threshold is None:
+            self.fluxes[self.length] = fluxes
+        else:
+            indices = np.flatnonzero(np.abs(fluxes) > self.sparse_threshold)
+            self._indices.write(indices.astype(np.int32).tobytes())
+            self._values.write(np.asarray(fluxes)[indices].astype(np.float32).tobytes())
+            self.indptr[self.length + 1] = self.indptr[self.length] + indices.size
+            self._indices.flush()
+            self._values.flush()
+        self.length += 1
+        self._write_index()
+
+    def _write_index(self):
+        # replaced atomically, so readers never see a length beyond the rows already written
+        self._index["length"] = min(self.length, self.steps)
+        temporary = os.path.join(self.path, "reactions.json.tmp")
+        with open(temporary, "w") as file:
+            json.dump(self._index, file)
+        os.replace(temporary, os.path.join(self.path, "reactions.json"))
+
+    def flush(self):
+        """Write everything recorded so far to disk"""
+        self.time.flush()
+        if self.sparse_threshold is None:
+            self.fluxes.flush()
+        else:
+            self.indptr.flush()
+            self._indices.flush()
+            self._values.flush()
+
+    def close(self):
+        """Flush and close the output files"""
+        if self.sparse_threshold is not None and not self._indices.closed:
+            self.flush()
+            self._indices.close()
+            self._values.close()
+        elif self.sparse_threshold is None:
+            self.flush()
+
+def load_flux_trajectory(path):
+    """Opens a trajectory written by `FluxRecorder`, memory-mapped
+    Parameters:
+        path: str, output directory of a FluxRecorder
+    Returns:
+        reactions: list of str, reaction IDs (columns)
+        time: np.ndarray, time of each recorded step
+        fluxes: np.memmap (recorded steps, reactions), OR scipy.sparse.csr_matrix for sparse recordings
+    """
+    from scipy.sparse import csr_matrix
+    with open(os.path.join(path, "reactions.json")) as file:
+        index = json.load(file)
+    length = index["length"]
+    time = np.load(os.path.join(path, "time.npy"), mmap_mode="r")[:length]
+    if not index["sparse"]:
+        return index["reactions"], time, np.load(os.path.join(path, "fluxes.npy"), mmap_mode="r")[:length]
+    indptr = np.array(np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")[:length + 1])
+    size = int(indptr[-1])
+    indices = np.memmap(os.path.join(path, "indices.bin"), dtype=np.int32, mode="r") if size else np.empty(0, np.int32)
+    values = np.memmap(os.path.join(path, "values.bin"), dtype=np.float32, mode="r") if size else np.empty(0, np.float32)
+    fluxes = csr_matrix((values[:size], indices[:size], indptr), shape=(length, len(index["reactions"])))
+    return index["reactions"], time, fluxes
+
+#=======
+# TESTS
+#=======
+
+def test_column_store():
+    store = ColumnStore(capacity=2)
+    store.append(0.0, {"glucose": 10.0, "E.coli": 0.1})
+    store.append(1.0, {"glucose": 9.0, "E.coli": 0.2})
+    store.append(2.0, {"glucose": 8.0, "E.coli": 0.4, "E.coli 2": 0.1})
+    store.append(3.0, {"glucose": 7.0, "E.coli": 0.8})
+
+    frame = store.to_dataframe()
+    assert list(frame.columns) == ["glucose", "E.coli", "E.coli 2"]
+    assert list(frame.index) == [0.0, 1.0, 2.0, 3.0]
+    assert np.isnan(frame["E.coli 2"].iloc[[0, 1, 3]]).all()
+    assert frame["E.coli 2"].iloc[2] == 0.1
+    assert np.shares_memory(frame.values, store.data)
+
+def test_environment_emitter():
+    from cdFBA.data_types import register_types
+    core = register_types(allocate_core())
+
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=2)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    set_concentration(spec, {"D-Glucose": 10, "Acetate": 0})
+    spec["emitter"] = get_environment_emitter_spec(capacity=4)
+
+    sim = Composite({"state": spec}, core=core)
+    sim.run(10)
+    results = gather_emitter_results(sim)[("emitter",)]
+
+    assert len(results["global_time"]) == 11
+    assert results["concentrations"]["D-Glucose"][-1] < results["concentrations"]["D-Glucose"][0]
+    assert results["counts"]["E.coli"][-1] > results["counts"]["E.coli"][0]
+    frame = sim.state["emitter"]["instance"].to_dataframe("counts")
+    assert frame.shape == (11, 3)
+
+def test_flux_recorder(tmp_path, core):
+    records = {
+        "dense": {"steps": 3},
+        "sparse": {"steps": 3, "decimation": 2, "sparse_threshold": 1e-6},
+    }
+    for name, record in records.items():
+        spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=2)
+        set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+        set_concentration(spec, {"D-Glucose": 100, "Acetate": 0})
+        spec["Species"]["E.coli"]["config"]["flux_record"] = dict(record, path=str(tmp_path / name))
+        sim = Composite({"state": spec}, core=core)
+        sim.run(3)
+        biomass_identifier = sim.state["Species"]["E.coli"]["instance"].biomass_identifier
+
+        # readable right after the run, without flushing or closing the recorder
+        if name == "dense":
+            reactions, time, fluxes = load_flux_trajectory(str(tmp_path / "dense" / "E.coli"))
+            assert fluxes.shape == (3, 95) and fluxes.dtype == np.float32
+            assert list(time) == [0.0, 1.0, 2.0]
+            assert fluxes[0, reactions.index(biomass_identifier)] > 0
+        else:
+            # two of the three preallocated rows are recorded
+            reactions, time, sparse_fluxes = load_flux_trajectory(str(tmp_path / "sparse" / "E.coli"))
+            assert sparse_fluxes.shape == (2, 95) and list(time) == [0.0, 2.0]
+            assert np.allclose(sparse_fluxes.toarray(), np.where(np.abs(fluxes[[0, 2]]) > 1e-6, fluxes[[0, 2]], 0))
+            assert sparse_fluxes.nnz < fluxes[[0, 2]].size
+
+def test_chunked_emitter(tmp_path):
+    from cdFBA.data_types import register_types
+    core = register_types(allocate_core())
+
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=2)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    set_concentration(spec, {"D-Glucose": 10, "Acetate": 0})
+    spec["emitter"] = get_chunked_emitter_spec(str(tmp_path), chunk_size=4, dfba_results=True)
+
+    sim = Composite({"state": spec}, core=core)
+    sim.run(10)
+    # readable before the final flush: only full chunks are on disk, as many as the writer has finished
+    trajectory = ChunkedTrajectory(str(tmp_path))
+    assert len(trajectory) in (0, 4, 8)
+
+    flush_chunked_emitters(sim)
+    trajectory.refresh()
+    assert len(trajectory) == 11
+    assert len(gather_emitter_results(sim)[("emitter",)]) == 11
+    sim.state["emitter"]["instance"].close()
+    assert list(trajectory.time()) == [float(t) for t in range(11)]
+    glucose = trajectory.read("concentrations", ["D-Glucose"])["D-Glucose"]
+    assert glucose.iloc[-1] < glucose.iloc[0]
+    assert "E.coli/E.coli" in trajectory.columns("dfba_results")
+    assert isinstance(next(trajectory.chunks("counts"))[2], np.memmap)
@@ -1,5 +1,11 @@
 from pprint import pprint
+import math
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
+from scipy.sparse import csr_matrix, diags
+from scipy.spatial import cKDTree
 
 from process_bigraph import allocate_core, Process, Step, Composite
 from process_bigraph.emitter import gather_emitter_results
@@ -8,14 +14,17 @@ from cdFBA.utils import SHARED_ENVIRONMENT, SPECIES_STORE, THRESHOLDS, DFBA_RESU
 from cdFBA.utils import get_single_dfba_spec, set_concentration, make_cdfba_composite, set_kinetics
 from cdFBA.processes.dfba import dFBA, UpdateEnvironment
 
-from matplotlib import pyplot as plt
 
-def create_spatial(dims, distance):
+def create_spatial(dims, distance, index=False):
     """Creates a spec for shared environments in Euclidean Space
 
     Parameters:
         dims: list of int, number of compartments in each spatial dimension [x, y, z]
         distance: float, distance between neighboring voxels
+        index: bool, if True also return the `SpatialIndex` of the lattice
+    Returns:
+        fields: dict, spec with the location of each voxel
+        index: SpatialIndex, only if `index` is True
     """
 
     fields = {
@@ -35,8 +44,586 @@ def create_spatial(dims, distance):
                 fields[FIELDS][f"[{field}]"]["location"] = [i, j, k]
                 field += 1
 
+    if index:
+        return fields, SpatialIndex(dims, distance)
     return fields
 
+class SpatialIndex:
+    """Topology index of a voxel lattice built by `create_spatial`
+
+    Flat voxel indices are the "[n]" keys of `create_spatial`. Neighbor lookups are O(1) slices of a CSR adjacency
+    matrix, point lookups are O(1) (`voxel_at`) or O(log n) (`nearest`).
+
+    Attributes:
+    -----------
+    shape: tuple of int, (x, y, z) voxel counts
+    ijk: np.ndarray, (voxels, 3) lattice coordinates of each flat index
+    flat: np.ndarray, (x, y, z) flat index of each lattice coordinate
+    centers: np.ndarray, (voxels, 3) voxel centers, same as the `create_spatial` locations
+    adjacency: scipy.sparse.csr_matrix, face-sharing neighbors weighted by face area / center distance
+    tree: scipy.spatial.cKDTree, KD-tree over the voxel centers
+    """
+    def __init__(self, dims, distance):
+        self.distance = distance
+        self.shape = lattice_shape(dims)
+        size = int(np.prod(self.shape))
+        self.flat = np.arange(size).reshape(self.shape)
+        self.ijk = np.stack(np.unravel_index(np.arange(size), self.shape), axis=1)
+        self.centers = (self.ijk + 0.5) * distance
+        if dims[2] == 0:
+            self.centers[:, 2] = 0
+
+        rows, cols = [], []
+        for axis in range(3):
+            lower = np.take(self.flat, range(self.shape[axis] - 1), axis=axis).ravel()
+            upper = np.take(self.flat, range(1, self.shape[axis]), axis=axis).ravel()
+            rows.extend([lower, upper])
+            cols.extend([upper, lower])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        # face area / distance between centers
+        weights = np.full(rows.shape, distance**2 / distance)
+        self.adjacency = csr_matrix((weights, (rows, cols)), shape=(size, size))
+        self.adjacency.sort_indices()
+        self.tree = cKDTree(self.centers)
+
+    def __len__(self):
+        return self.ijk.shape[0]
+
+    def to_flat(self, i, j, k=0):
+        """Returns the flat index of lattice coordinate (i, j, k)"""
+        return int(self.flat[i, j, k])
+
+    def to_ijk(self, voxel):
+        """Returns the lattice coordinate (i, j, k) of a flat index"""
+        return tuple(int(value) for value in self.ijk[voxel])
+
+    def neighbors(self, voxel):
+        """Returns the flat indices of the voxels sharing a face with `voxel`"""
+        return self.adjacency.indices[self.adjacency.indptr[voxel]:self.adjacency.indptr[voxel + 1]]
+
+    def face_weights(self, voxel):
+        """Returns the face weights to each of `neighbors(voxel)`"""
+        return self.adjacency.data[self.adjacency.indptr[voxel]:self.adjacency.indptr[voxel + 1]]
+
+    def voxel_at(self, point):
+        """Returns the flat index of the voxel containing `point`, or None if it is outside the lattice"""
+        ijk = np.floor(np.asarray(point, dtype=float) / self.distance).astype(int)
+        if self.shape[2] == 1:
+            ijk[2] = 0
+        if np.any(ijk < 0) or np.any(ijk >= self.shape):
+            return None
+        return int(self.flat[tuple(ijk)])
+
+    def nearest(self, points, k=1):
+        """Returns the flat indices of the k voxels whose centers are nearest to each point"""
+        _, voxels = self.tree.query(points, k=k)
+        return voxels
+
+    def laplacian(self):
+        """Returns the finite-volume diffusion operator (CSR), so that d(concentration)/dt = D * laplacian @ c"""
+        volume = self.distance**3
+        return (self.adjacency - diags(np.asarray(self.adjacency.sum(axis=1)).ravel())).tocsr() / volume
+
+#=================
+# Spatial kernels
+#=================
+
+def lattice_shape(dims):
+    """Returns the (x, y, z) voxel counts of a lattice built by `create_spatial`. A z dimension of 0 is a single
+    layer of voxels, and voxel "[n]" of `create_spatial` is the flat (C-order) index n of this shape.
+    Parameters:
+        dims: list of int, number of compartments in each spatial dimension [x, y, z]
+    Returns:
+        shape: tuple of int
+    """
+    return (int(dims[0]), int(dims[1]), max(int(dims[2]), 1))
+
+def diffusion_substeps(diffusion, distance, interval, shape):
+    """Returns the number of explicit diffusion sub-steps needed to keep a step of length `interval` stable
+    Parameters:
+        diffusion: np.ndarray, diffusion coefficient for each field key
+        distance: float, distance between neighboring voxels
+        interval: float, length of the full step
+        shape: tuple of int, lattice shape
+    Returns:
+        substeps: int
+    """
+    ndim = max(sum(1 for size in shape if size > 1), 1)
+    rate = float(np.max(diffusion, initial=0.0)) * interval / distance**2
+    return max(1, math.ceil(2 * ndim * rate))
+
+def diffuse(source, target, diffusion, distance, interval, start=0, stop=None):
+    """Explicit finite-volume diffusion with no-flux boundaries over the x-slab [start, stop) of the lattice.
+    Only the slab and its two neighboring x-layers (the halo) are read from `source`, so slabs can be updated
+    independently, and a slab-wise update is identical to updating the whole lattice at once.
+    Parameters:
+        source: np.ndarray, (keys, x, y, z) concentrations at the start of the step
+        target: np.ndarray, (keys, x, y, z) array that receives the updated concentrations of the slab
+        diffusion: np.ndarray, diffusion coefficient for each key
+        distance: float, distance between neighboring voxels
+        interval: float, length of the step (must be stable, see `diffusion_substeps`)
+        start: int, first x-layer of the slab
+        stop: int, x-layer after the last one in the slab (defaults to the lattice size)
+    """
+    size = source.shape[1]
+    stop = size if stop is None else stop
+    low, high = max(start - 1, 0), min(stop + 1, size)
+    # edge padding mirrors the outer layer, which gives zero flux across the lattice boundary
+    padded = np.pad(source[:, low:high], ((0, 0), (1, 1), (1, 1), (1, 1)), mode="edge")
+    first, last = start - low + 1, stop - low + 1
+    center = padded[:, first:last, 1:-1, 1:-1]
+    laplacian = (
+        ((padded[:, first-1:last-1, 1:-1, 1:-1] - center) + (padded[:, first+1:last+1, 1:-1, 1:-1] - center))
+        + ((padded[:, first:last, :-2, 1:-1] - center) + (padded[:, first:last, 2:, 1:-1] - center))
+        + ((padded[:, first:last, 1:-1, :-2] - center) + (padded[:, first:last, 1:-1, 2:] - center))
+    )
+    rate = (diffusion * interval / distance**2)[:, None, None, None]
+    target[:, start:stop] = center + rate * laplacian
+
+# dFBA options that keep per-species state from one update to the next, which `react` would share between voxels
+SPATIAL_UNSUPPORTED = ("multirate", "flux_record", "share_solves", "dormancy_threshold")
+
+def check_spatial_config(name, config):
+    """Raises a ValueError if a dFBA config uses options the spatial runners do not support (see `react`)"""
+    for option in SPATIAL_UNSUPPORTED:
+        if config.get(option):
+            raise ValueError(
+                f"The dFBA option {option} of {name} keeps state across steps and is not supported by the spatial "
+                f"runners, which run one dFBA instance in every voxel (use active_threshold instead of dormancy)")
+
+def react(processes, keys, state, voxels, volume, interval):
+    """Runs the dFBA of every species in each of the given voxels and applies the summed updates in place.
+    Counts are clipped at zero, and species are always applied in the same order so runs are reproducible.
+    One dFBA instance per species is updated once per voxel, so its config must not use the options in
+    `SPATIAL_UNSUPPORTED` (see `check_spatial_config`).
+    Parameters:
+        processes: list, dFBA process instances
+        keys: list of str, substrate and species names, in the order of the first axis of `state`
+        state: np.ndarray, (keys, voxels) concentrations
+        voxels: iterable of int, flat indices of the voxels to update
+        volume: float, volume of a single voxel
+        interval: float, time-step
+    """
+    for voxel in voxels:
+        concentrations = dict(zip(keys, state[:, voxel].tolist()))
+        counts = {key: value * volume for key, value in concentrations.items()}
+        environment = {"counts": counts, "concentrations": concentrations, "volume": volume}
+        delta = dict.fromkeys(keys, 0.0)
+        for process in processes:
+            update = process.update({"shared_environment": environment, "current_update": {}}, interval)
+            for key, value in update["dfba_update"].items():
+                delta[key] += value
+        for index, key in enumerate(keys):
+            state[index, voxel] = max(counts[key] + delta[key], 0.0) / volume
+
+def find_active(state, species_rows, voxels, threshold):
+    """Returns the (sorted) voxels among `voxels` in which the concentration of any species is above threshold
+    Parameters:
+        state: np.ndarray, (keys, voxels) concentrations
+        species_rows: list of int, rows of `state` holding species biomass
+        voxels: np.ndarray of int, sorted flat indices of the candidate voxels
+        threshold: float, biomass concentration above which a voxel is active
+    """
+    voxels = np.asarray(voxels, dtype=int)
+    if voxels.size == 0 or len(species_rows) == 0:
+        return voxels[:0]
+    return voxels[state[np.ix_(species_rows, voxels)].max(axis=0) > threshold]
+
+def expand_active(adjacency, voxels, hops):
+    """Returns `voxels` together with every voxel within `hops` faces of them
+    Parameters:
+        adjacency: scipy.sparse.csr_matrix, voxel adjacency (see `SpatialIndex`)
+        voxels: np.ndarray of int, sorted flat voxel indices
+        hops: int, number of neighbor layers to add
+    """
+    for _ in range(hops):
+        voxels = np.union1d(voxels, adjacency[voxels].indices)
+    return voxels
+
+def spread_active(state, species_rows, adjacency, active, spreading, hops, threshold, start=0, stop=None):
+    """Updates the active voxels after a reaction and diffusion step.
+
+    Voxels outside the active set do not react, so their biomass only changes by diffusion. A stable explicit
+    diffusion step is a weighted average over the neighbors, so biomass can only rise above the threshold within
+    `hops` faces of a voxel that was above it. Only those voxels (and the current active set, to drop voxels
+    where biomass died out) are checked, so the cost grows with the size of the colony, not of the lattice.
+    Parameters:
+        state: np.ndarray, (keys, voxels) concentrations
+        species_rows: list of int, rows of `state` holding species biomass
+        adjacency: scipy.sparse.csr_matrix, voxel adjacency (see `SpatialIndex`)
+        active: np.ndarray of int, sorted active voxels before the step
+        spreading: bool, whether any species diffuses
+        hops: int, number of diffusion sub-steps in the step
+        threshold: float, biomass concentration above which a voxel is active
+        start, stop: int, range of flat indices to keep (defaults to all voxels)
+    Returns:
+        active: np.ndarray of int, sorted active voxels after the step
+    """
+    candidates = expand_active(adjacency, active, hops) if spreading else active
+    stop = state.shape[1] if stop is None else stop
+    candidates = candidates[(candidates >= start) & (candidates < stop)]
+    return find_active(state, species_rows, candidates, threshold)
+
+#=================
+# Spatial runners
+#=================
+
+class SpatialDFBA:
+    """Runs dFBA in every voxel of a lattice built by `create_spatial`, coupled by diffusion
+
+    Each step solves the dFBA of every species in every active voxel, then diffuses all fields over the whole
+    lattice. With `active_threshold` set, only voxels where some species' biomass concentration is above the
+    threshold are active; the active set is updated incrementally as biomass spreads or dies out, so the number of
+    LP solves per step follows the size of the colony. Biomass below the threshold does not grow.
+
+    Parameters:
+    -----------
+    spec: dict, cdFBA composite spec (see `make_cdfba_composite`). Provides the dFBA config of each species and the
+          initial concentrations, which are applied to every voxel
+    dims: list of int, number of compartments in each spatial dimension [x, y, z]
+    distance: float, distance between neighboring voxels
+    diffusion: dict, diffusion coefficient for each substrate/species. Missing keys do not diffuse
+    core: process-bigraph core with the cdFBA types registered. A new one is created if None
+    active_threshold: float, biomass concentration above which a voxel is active. If None, every voxel is active
+    """
+    def __init__(self, spec, dims, distance, diffusion=None, core=None, active_threshold=None):
+        self.dims = dims
+        self.distance = distance
+        self.index = SpatialIndex(dims, distance)
+        self.shape = self.index.shape
+        self.volume = distance**3
+        self.keys = list(spec[SHARED_ENVIRONMENT]["concentrations"].keys())
+        self.species = {name: species["config"] for name, species in spec[SPECIES_STORE].items()}
+        for name, config in self.species.items():
+            check_spatial_config(name, config)
+        diffusion = diffusion or {}
+        self.diffusion = np.array([diffusion.get(key, 0.0) for key in self.keys], dtype=float)
+        self.species_rows = [self.keys.index(name) for name in self.species]
+        self.active_threshold = active_threshold
+        self._active = None
+        self.time = 0.0
+
+        initial = np.array([spec[SHARED_ENVIRONMENT]["concentrations"][key] for key in self.keys], dtype=float)
+        self.fields = np.empty((len(self.keys),) + self.shape)
+        self.fields[:] = initial[:, None, None, None]
+        self.scratch = np.empty_like(self.fields)
+
+        self.core = core
+        self.processes = None
+
+    def _start(self):
+        if self.core is None:
+            self.core = get_spatial_core()
+        self.processes = [dFBA(config, self.core) for config in self.species.values()]
+
+    def field(self, key):
+        """Returns the (x, y, z) concentration array of a substrate or species"""
+        return self.fields[self.keys.index(key)]
+
+    def set_voxel(self, voxel, concentrations):
+        """Set concentrations in a single voxel
+        Parameters:
+            voxel: int, flat voxel index (voxel "[n]" of `create_spatial`), OR
+                   list of float, a point inside the lattice
+            concentrations: dict, substrate/species names as keys and concentrations as values
+        """
+        if not isinstance(voxel, (int, np.integer)):
+            point = voxel
+            voxel = self.index.voxel_at(point)
+            if voxel is None:
+                raise ValueError(f"{point} is outside the spatial lattice")
+        flat = self.fields.reshape(len(self.keys), -1)
+        for key, value in concentrations.items():
+            flat[self.keys.index(key), voxel] = value
+        self._active = None
+
+    @property
+    def active_voxels(self):
+        """Sorted flat indices of the voxels in which dFBA is solved"""
+        flat = self.fields.reshape(len(self.keys), -1)
+        if self.active_threshold is None:
+            return np.arange(flat.shape[1])
+        if self._active is None:
+            self._active = find_active(flat, self.species_rows, np.arange(flat.shape[1]), self.active_threshold)
+        return self._active
+
+    def step(self, interval):
+        """Advance all voxels by a single time-step"""
+        if self.processes is None:
+            self._start()
+        flat = self.fields.reshape(len(self.keys), -1)
+        active = self.active_voxels
+        react(self.processes, self.keys, flat, active, self.volume, interval)
+        substeps = diffusion_substeps(self.diffusion, self.distance, interval, self.shape)
+        for _ in range(substeps):
+            diffuse(self.fields, self.scratch, self.diffusion, self.distance, interval / substeps)
+            self.fields[:] = self.scratch
+        if self.active_threshold is not None:
+            spreading = bool(np.any(self.diffusion[self.species_rows] > 0))
+            self._active = spread_active(
+                flat, self.species_rows, self.index.adjacency, active, spreading, substeps, self.active_threshold)
+        self.time += interval
+
+    def run(self, duration, interval=1.0):
+        """Run the spatial simulation
+        Parameters:
+            duration: float, total simulated time
+            interval: float, time-step
+        """
+        for _ in range(round(duration / interval)):
+            self.step(interval)
+
+
+class DecomposedSpatialDFBA(SpatialDFBA):
+    """Runs `SpatialDFBA` with the lattice split into x-slabs, one per worker process
+
+    Every worker keeps its own dFBA processes (and cobra models) for the whole run and updates only its slab.
+    All fields live in shared memory, so the boundary layers a slab needs for diffusion are read directly from
+    the neighboring slabs instead of being sent between processes. Workers synchronize with a barrier between the
+    reaction and diffusion phases, and use the same kernels as `SpatialDFBA`, so results match a single-process run.
+
+    Parameters:
+    -----------
+    workers: int, number of worker processes (at most the number of x-layers). Defaults to the CPU count
+    start_method: str, multiprocessing start method ("fork", "spawn", "forkserver"). Platform default if None
+    (other parameters as in `SpatialDFBA`)
+    """
+    def __init__(self, spec, dims, distance, diffusion=None, core=None, active_threshold=None, workers=None,
+                 start_method=None):
+        super().__init__(spec, dims, distance, diffusion=diffusion, core=core, active_threshold=active_threshold)
+        workers = workers or mp.cpu_count()
+        workers = max(1, min(workers, self.shape[0]))
+        self.slabs = [(int(layers[0]), int(layers[-1]) + 1) for layers in np.array_split(np.arange(self.shape[0]), workers)]
+        self.context = mp.get_context(start_method)
+
+        self._memory = []
+        self.fields = self._share(self.fields)
+        self.scratch = self._share(self.scratch)
+        self._workers = []
+        self._connections = []
+
+    def _share(self, array):
+        memory = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        self._memory.append(memory)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+        shared[:] = array
+        return shared
+
+    def _start(self):
+        barrier = self.context.Barrier(len(self.slabs))
+        layout = {
+            "fields": self._memory[0].name,
+            "scratch": self._memory[1].name,
+            "shape": self.fields.shape,
+            "dims": self.dims,
+            "keys": self.keys,
+            "species_rows": self.species_rows,
+            "active_threshold": self.active_threshold,
+            "diffusion": self.diffusion,
+            "distance": self.distance,
+            "volume": self.volume,
+        }
+        for start, stop in self.slabs:
+            parent, child = self.context.Pipe()
+            worker = self.context.Process(
+                target=_slab_worker,
+                args=(child, barrier, layout, self.species, start, stop),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+            self._connections.append(parent)
+        self.processes = self._workers
+
+    def _command(self, *message):
+        if not self._workers:
+            self._start()
+        for connection in self._connections:
+            connection.send(message)
+        errors = [reply[1] for reply in (connection.recv() for connection in self._connections) if reply[0] == "error"]
+        if errors:
+            self.close()
+            raise RuntimeError(f"Spatial worker failed:\n{errors[0]}")
+
+    @property
+    def active_voxels(self):
+        flat = self.fields.reshape(len(self.keys), -1)
+        if self.active_threshold is None:
+            return np.arange(flat.shape[1])
+        return find_active(flat, self.species_rows, np.arange(flat.shape[1]), self.active_threshold)
+
+    def step(self, interval):
+        self.run(interval, interval)
+
+    def run(self, duration, interval=1.0):
+        steps = round(duration / interval)
+        if steps > 0:
+            self._command("run", steps, interval)
+            self.time += steps * interval
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        for connection in self._connections:
+            try:
+                connection.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers, self._connections = [], []
+        if self._memory:
+            self.fields = np.array(self.fields)
+            self.scratch = np.array(self.scratch)
+            for memory in self._memory:
+                memory.close()
+                memory.unlink()
+            self._memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, "_workers"):
+            self.close()
+
+def _slab_worker(connection, barrier, layout, species, start, stop):
+    """Worker loop of `DecomposedSpatialDFBA`: owns the x-slab [start, stop)"""
+    memories = [shared_memory.SharedMemory(name=layout[name]) for name in ("fields", "scratch")]
+    try:
+        fields, scratch = (np.ndarray(layout["shape"], dtype=float, buffer=memory.buf) for memory in memories)
+        keys, diffusion, distance = layout["keys"], layout["diffusion"], layout["distance"]
+        flat = fields.reshape(len(keys), -1)
+        layer = fields.shape[2] * fields.shape[3]
+        first, last = start * layer, stop * layer
+        species_rows, threshold = layout["species_rows"], layout["active_threshold"]
+        spreading = bool(np.any(diffusion[species_rows] > 0))
+        adjacency = SpatialIndex(layout["dims"], distance).adjacency
+        core = get_spatial_core()
+        processes = [dFBA(config, core) for config in species.values()]
+
+        while True:
+            message = connection.recv()
+            if message[0] == "stop":
+                break
+            _, steps, interval = message
+            try:
+                substeps = diffusion_substeps(diffusion, distance, interval, fields.shape[1:])
+                # voxels within reach of biomass spreading in from the neighboring slabs
+                boundary = np.arange(first, last)
+                if spreading:
+                    reach = min(substeps, stop - start) * layer
+                    boundary = np.union1d(
+                        np.arange(first, first + reach) if start > 0 else [],
+                        np.arange(last - reach, last) if stop < fields.shape[1] else [],
+                    ).astype(int)
+                active = np.arange(first, last)
+                if threshold is not None:
+                    active = find_active(flat, species_rows, active, threshold)
+                for _ in range(steps):
+                    react(processes, keys, flat, active, layout["volume"], interval)
+                    for _ in range(substeps):
+                        barrier.wait()  # all slabs reacted/copied before halos are read
+                        diffuse(fields, scratch, diffusion, distance, interval / substeps, start, stop)
+                        barrier.wait()  # all halos read before any slab is overwritten
+                        fields[:, start:stop] = scratch[:, start:stop]
+                    if threshold is not None:
+                        active = spread_active(flat, species_rows, adjacency, active, spreading, substeps, threshold,
+                                               first, last)
+                        if spreading:
+                            active = np.union1d(active, find_active(flat, species_rows, boundary, threshold))
+                barrier.wait()
+                connection.send(("done",))
+            except Exception:
+                barrier.abort()
+                connection.send(("error", traceback.format_exc()))
+                break
+    finally:
+        for memory in memories:
+            memory.close()
+
+def get_spatial_core():
+    """Returns a process-bigraph core with the cdFBA types and processes registered"""
+    from cdFBA.data_types import register_types
+    return register_types(allocate_core())
+
+#=======
+# TESTS
+#=======
+
+def get_spatial_test_spec():
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    set_concentration(spec, {"D-Glucose": 10, "Acetate": 0, "E.coli": 0})
+    return spec
+
+def test_decomposed_matches_single_process():
+    spec = get_spatial_test_spec()
+    dims, distance, diffusion = [4, 3, 0], 1.0, {"D-Glucose": 0.2, "Acetate": 0.2, "E.coli": 0.05}
+
+    single = SpatialDFBA(spec, dims, distance, diffusion=diffusion)
+    single.set_voxel(0, {"E.coli": 0.5})
+    single.run(2, interval=0.5)
+
+    with DecomposedSpatialDFBA(spec, dims, distance, diffusion=diffusion, workers=2) as decomposed:
+        decomposed.set_voxel(0, {"E.coli": 0.5})
+        decomposed.run(2, interval=0.5)
+        fields = np.array(decomposed.fields)
+
+    assert np.allclose(single.fields, fields, rtol=1e-12, atol=1e-12)
+    assert single.field("E.coli")[0, 0, 0] > 0.5
+    assert single.field("E.coli")[1, 0, 0] > 0
+
+def test_active_voxels():
+    spec = get_spatial_test_spec()
+    dims, distance, diffusion = [6, 2, 0], 1.0, {"D-Glucose": 0.2, "Acetate": 0.2, "E.coli": 0.1}
+
+    full = SpatialDFBA(spec, dims, distance, diffusion=diffusion)
+    sparse = SpatialDFBA(spec, dims, distance, diffusion=diffusion, active_threshold=0.0)
+    for runner in (full, sparse):
+        runner.set_voxel([0.5, 0.5, 0], {"E.coli": 0.5})
+    assert list(sparse.active_voxels) == [0]
+
+    solves = []
+    for _ in range(3):
+        solves.append(len(sparse.active_voxels))
+        full.step(0.5)
+        sparse.step(0.5)
+
+    # only voxels reached by biomass solve an LP, and the result matches solving everywhere
+    assert solves == [1, 3, 5]
+    assert np.array_equal(full.fields, sparse.fields)
+
+    # options with per-species state across steps are rejected before any worker starts
+    import pytest
+    spec[SPECIES_STORE]["E.coli"]["config"]["multirate"] = {"growth_tolerance": 0.05}
+    with pytest.raises(ValueError, match="multirate"):
+        DecomposedSpatialDFBA(spec, dims, distance, workers=2)
+    spec[SPECIES_STORE]["E.coli"]["config"]["multirate"] = None
+
+    with DecomposedSpatialDFBA(spec, dims, distance, diffusion=diffusion, active_threshold=0.0, workers=3) as decomposed:
+        decomposed.set_voxel(0, {"E.coli": 0.5})
+        decomposed.run(1.5, interval=0.5)
+        assert np.allclose(decomposed.fields, sparse.fields, rtol=1e-12, atol=1e-12)
+
+def test_spatial_index():
+    fields, index = create_spatial(dims=[3, 4, 2], distance=2.0, index=True)
+    locations = np.array([voxel["location"] for voxel in fields[FIELDS].values()])
+
+    assert np.allclose(index.centers, locations)
+    assert index.to_flat(*index.to_ijk(17)) == 17
+    center = index.to_flat(1, 1, 0)
+    assert sorted(index.to_ijk(voxel) for voxel in index.neighbors(center)) == [(0, 1, 0), (1, 0, 0), (1, 1, 1), (1, 2, 0), (2, 1, 0)]
+    assert np.all(index.face_weights(center) == 2.0)
+    assert index.voxel_at([3.5, 0.1, 3.9]) == index.to_flat(1, 0, 1)
+    assert index.voxel_at([6.5, 0, 0]) is None
+    assert index.nearest([[100.0, 100.0, 100.0]])[0] == index.to_flat(2, 3, 1)
+    assert np.allclose(index.laplacian().sum(axis=1), 0)
+
 if __name__ == "__main__":
     fields = create_spatial(dims=[2, 2, 2], distance=1)
-    pprint(fields)
\ No newline at end of file
+    pprint(fields)
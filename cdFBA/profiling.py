@@ -0,0 +1,210 @@
+"""This module contains opt-in timing instrumentation for cdFBA processes.
+
+The cdFBA processes mark their `update` with `profiled` and the phases inside it (bound setting, LP solve, ...) with
+`phase`. Nothing is recorded until a `Profiler` is enabled; while disabled, `profiled` costs one global lookup per
+update and `phase` returns a shared no-op context manager. `profile_composite` additionally times the process-bigraph
+view, projection and update application of a composite.
+
+Example:
+    with profiling() as profiler:
+        profile_composite(sim)
+        sim.run(10)
+    print(profiler.summary())
+    profiler.to_chrome_trace("trace.json")   # open in chrome://tracing or ui.perfetto.dev
+"""
+import os
+import json
+import time
+import functools
+import contextlib
+import pandas as pd
+
+_PROFILER = None
+_NULL_PHASE = contextlib.nullcontext()
+
+def _label(process):
+    """Returns the label of a process in profiles, e.g. "dFBA:E.coli" or "UpdateEnvironment" """
+    config = getattr(process, "config", None)
+    if isinstance(config, dict) and config.get("name"):
+        return f"{type(process).__name__}:{config['name']}"
+    return type(process).__name__
+
+class _Phase:
+    __slots__ = ("profiler", "label", "name", "wall", "cpu")
+
+    def __init__(self, profiler, label, name):
+        self.profiler = profiler
+        self.label = label
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        self.profiler.records.append(
+            (self.label, self.name, self.profiler.steps.get(self.label, 0), self.wall, wall, cpu))
+        return False
+
+class Profiler:
+    """Collects wall and CPU time per phase, per process and per step
+
+    Records are tuples of (process label, phase, step, start time, wall time, CPU time), with times in seconds. The
+    step of a process is the number of its updates started so far.
+    """
+    def __init__(self):
+        self.records = []
+        self.steps = {}
+        self.origin = time.perf_counter()
+
+    def phase(self, label, name):
+        return _Phase(self, label, name)
+
+    def reset(self):
+        self.records = []
+        self.steps = {}
+        self.origin = time.perf_counter()
+
+    def to_dataframe(self):
+        """Returns the records as a dataframe"""
+        return pd.DataFrame(self.records, columns=["process", "phase", "step", "start", "wall", "cpu"])
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Returns the count, total and percentiles of the wall time, and the total CPU time, of every process phase
+        Parameters:
+            percentiles: list of int, wall time percentiles to report
+        Returns:
+            summary: pd.DataFrame, indexed by (process, phase), sorted by total wall time
+        """
+        records = self.to_dataframe()
+        groups = records.groupby(["process", "phase"])
+        summary = groups["wall"].agg(["count", "sum", "mean"]).rename(columns={"sum": "wall_total", "mean": "wall_mean"})
+        for percentile in percentiles:
+            summary[f"wall_p{percentile}"] = groups["wall"].quantile(percentile / 100)
+        summary["cpu_total"] = groups["cpu"].sum()
+        return summary.sort_values("wall_total", ascending=False)
+
+    def to_chrome_trace(self, path):
+        """Write the records as a Chrome trace-event file, one row per process
+        Parameters:
+            path: str, output JSON file
+        """
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for label, name, step, start, wall, cpu in self.records:
+            tid = threads.setdefault(label, len(threads))
+            events.append({
+                "name": name,
+                "cat": label,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": wall * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {"step": step, "cpu_us": cpu * 1e6},
+            })
+        for label, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": label}})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+def enable_profiling(profiler=None):
+    """Start recording into a profiler. Returns the profiler"""
+    global _PROFILER
+    _PROFILER = profiler or Profiler()
+    return _PROFILER
+
+def disable_profiling():
+    """Stop recording. Returns the profiler that was recording, if any"""
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    return profiler
+
+def get_profiler():
+    """Returns the recording profiler, or None if profiling is disabled"""
+    return _PROFILER
+
+@contextlib.contextmanager
+def profiling(profiler=None):
+    """Context manager that records into a profiler while it is open"""
+    profiler = enable_profiling(profiler)
+    try:
+        yield profiler
+    finally:
+        disable_profiling()
+
+def phase(process, name):
+    """Context manager timing one phase of a process update, or a no-op if profiling is disabled
+    Parameters:
+        process: the process instance, or a label string
+        name: str, phase name
+    """
+    if _PROFILER is None:
+        return _NULL_PHASE
+    return _PROFILER.phase(process if isinstance(process, str) else _label(process), name)
+
+def profiled(update):
+    """Decorator timing a process or step `update` as the "update" phase and counting its steps"""
+    @functools.wraps(update)
+    def wrapper(self, *args, **kwargs):
+        profiler = _PROFILER
+        if profiler is None:
+            return update(self, *args, **kwargs)
+        label = _label(self)
+        profiler.steps[label] = profiler.steps.get(label, 0) + 1
+        with profiler.phase(label, "update"):
+            return update(self, *args, **kwargs)
+    return wrapper
+
+def profile_composite(sim):
+    """Time the view, projection and update application of a composite under the label "Composite".
+
+    Wraps the methods on the instance, so other composites are not affected. Recording still only happens while a
+    profiler is enabled.
+    Parameters:
+        sim: Composite
+    """
+    for method, name in [("_cached_view", "view"), ("_cached_project", "project"), ("apply_updates", "apply")]:
+        original = getattr(sim, method)
+
+        def wrapper(*args, _original=original, _name=name, **kwargs):
+            with phase("Composite", _name):
+                return _original(*args, **kwargs)
+        setattr(sim, method, wrapper)
+    return sim
+
+#=======
+# TESTS
+#=======
+
+def test_profiling(tmp_path):
+    from process_bigraph import Composite, allocate_core
+    from cdFBA.data_types import register_types
+    from cdFBA.utils import make_cdfba_composite, set_kinetics
+    core = register_types(allocate_core())
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    sim = profile_composite(Composite({"state": spec}, core=core))
+
+    sim.run(2)
+    assert get_profiler() is None
+
+    with profiling() as profiler:
+        sim.run(3)
+    assert get_profiler() is None
+    summary = profiler.summary()
+    assert summary.loc[("dFBA:E.coli", "update"), "count"] == 3
+    assert summary.loc[("dFBA:E.coli", "solve"), "count"] == 3
+    assert ("UpdateEnvironment", "update") in summary.index
+    assert ("Composite", "apply") in summary.index
+    assert (summary["wall_p90"] >= summary["wall_p50"]).all()
+    assert profiler.to_dataframe().query("process == 'dFBA:E.coli'")["step"].max() == 3
+
+    profiler.to_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as file:
+        trace = json.load(file)
+    assert any(event["name"] == "solve" and event["ph"] == "X" for event in trace["traceEvents"])
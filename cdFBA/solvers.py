@@ -0,0 +1,274 @@
+"""This module contains LP solve paths for dFBA that avoid rebuilding or re-solving cobra models from scratch.
+"""
+import json
+import weakref
+import importlib.util
+import numpy as np
+
+from cdFBA.utils import get_objective_reaction
+
+def highs_available():
+    """Returns True if the optional `highspy` package is installed, without importing it"""
+    return importlib.util.find_spec("highspy") is not None
+
+def uptake_bounds(kinetics, concentrations):
+    """Returns the Michaelis-Menten exchange lower bounds used by `dFBA.update`, for many members at once
+    Parameters:
+        kinetics: np.ndarray, (members, exchanges, 2) array of (Km, Vmax)
+        concentrations: np.ndarray, (members, exchanges) substrate concentrations
+    Returns:
+        lower_bounds: np.ndarray, (members, exchanges)
+    """
+    kinetics = np.asarray(kinetics, dtype=float)
+    concentrations = np.asarray(concentrations, dtype=float)
+    Km, Vmax = kinetics[..., 0], kinetics[..., 1]
+    return -Vmax * concentrations / (Km + concentrations)
+
+def nearest_neighbor_order(points):
+    """Returns an order of the rows of `points` in which each row follows the closest row not yet visited
+    Parameters:
+        points: np.ndarray, (members, dimensions)
+    Returns:
+        order: list of int
+    """
+    points = np.asarray(points, dtype=float)
+    if len(points) == 0:
+        return []
+    remaining = np.ones(len(points), dtype=bool)
+    order = [0]
+    remaining[0] = False
+    for _ in range(len(points) - 1):
+        candidates = np.flatnonzero(remaining)
+        distances = np.abs(points[candidates] - points[order[-1]]).sum(axis=1)
+        current = int(candidates[np.argmin(distances)])
+        order.append(current)
+        remaining[current] = False
+    return order
+
+def solve_batch(model, reaction_ids, lower_bounds, outputs=None):
+    """Solves the LP of one species model for many sets of exchange lower bounds on a single LP object.
+
+    Members are solved in nearest-neighbor order of their bounds, so every solve warm-starts from the basis of
+    the most similar member solved before it. Bound changes are reverted when the batch is done.
+
+    Parameters:
+        model: cobra model
+        reaction_ids: list of str, exchange reactions whose lower bounds are set (columns of `lower_bounds`)
+        lower_bounds: np.ndarray, (members, exchanges) lower bounds, e.g. from `uptake_bounds`
+        outputs: list of str, reactions whose fluxes are returned. Defaults to the objective reaction followed by
+                 `reaction_ids`
+    Returns:
+        fluxes: np.ndarray, (members, outputs). Rows of members without an optimal solution are NaN
+    """
+    lower_bounds = np.atleast_2d(np.asarray(lower_bounds, dtype=float))
+    if outputs is None:
+        outputs = [get_objective_reaction(model)] + list(reaction_ids)
+    reactions = [model.reactions.get_by_id(reaction_id) for reaction_id in reaction_ids]
+    variables = [
+        (reaction.forward_variable, reaction.reverse_variable)
+        for reaction in (model.reactions.get_by_id(reaction_id) for reaction_id in outputs)
+    ]
+    fluxes = np.full((lower_bounds.shape[0], len(outputs)), np.nan)
+
+    with model:
+        for member in nearest_neighbor_order(lower_bounds):
+            for reaction, bound in zip(reactions, lower_bounds[member]):
+                reaction.lower_bound = bound
+            if model.solver.optimize() == "optimal":
+                fluxes[member] = [forward.primal - reverse.primal for forward, reverse in variables]
+    return fluxes
+
+def lp_iterations(model):
+    """Returns the cumulative simplex iteration count of the solver of a cobra model, or -1 if it is not available"""
+    if model.solver.interface.__name__ == "optlang.glpk_interface":
+        import swiglpk
+        return swiglpk.glp_get_it_cnt(model.solver.problem)
+    return -1
+
+def solve_signature(config):
+    """Returns a string identifying the LP of a dFBA config, equal for configs whose LPs are identical
+    under the same exchange lower bounds. Kinetics are left out, since they only enter through the bounds
+    Parameters:
+        config: dict, dFBA config
+    Returns:
+        signature: str
+    """
+    changes = {key: value for key, value in (config.get("changes") or {}).items() if key != "kinetics"}
+    return json.dumps([
+        config.get("model_file"),
+        config.get("medium") or {},
+        config.get("bounds") or {},
+        changes,
+        list((config.get("reaction_map") or {}).items()),
+        bool(config.get("compress")),
+        config.get("solver", "cobra"),
+    ], sort_keys=True, default=str)
+
+class SolveCache:
+    """Results of the LP solves of the current time step of one composite, shared by its dFBA processes
+
+    Entries are keyed by the `solve_signature` of the process, the substrate concentrations it sees and its exchange
+    lower bounds, so species with identical models seeing the same environment (replicate strains, a parent and its
+    unchanged child, ...) solve their LP once. The entries are dropped whenever the global time of the composite
+    changes, which includes the first step of every run.
+    """
+    def __init__(self):
+        self.time = None
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, time):
+        """Returns (status, fluxes) of an identical solve at this global time, or None if there was none"""
+        if time != self.time:
+            self.time = time
+            self.entries.clear()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def store(self, key, status, fluxes):
+        """Store the status and fluxes (None if not optimal) of a solve at the current global time"""
+        self.entries[key] = (status, fluxes)
+
+_SOLVE_CACHES = weakref.WeakKeyDictionary()
+
+def composite_solve_cache():
+    """Returns the SolveCache and global time of the composite being run, or (None, None) outside of `Composite.run`"""
+    from process_bigraph.composite import current_composite_var
+    composite = current_composite_var.get(None)
+    if composite is None:
+        return None, None
+    cache = _SOLVE_CACHES.get(composite)
+    if cache is None:
+        cache = _SOLVE_CACHES[composite] = SolveCache()
+    return cache, composite.state["global_time"]
+
+class HighsLP:
+    """The LP of a cobra model extracted once into arrays and solved by an in-process HiGHS instance (requires `highspy`)
+
+    Bounds are changed and fluxes are read by reaction index, without going through cobra and optlang. The cobra model
+    is only read at construction, so apply media, bounds and knockouts to it first. Only the mass balance constraints
+    and the linear objective of the model are used.
+
+    Parameters:
+        model: cobra model
+    """
+    def __init__(self, model):
+        try:
+            import highspy
+        except ImportError:
+            raise ImportError("The HiGHS solver backend requires highspy (pip install highspy)")
+        from scipy.sparse import csc_matrix
+        from cobra.util.array import create_stoichiometric_matrix
+
+        self.reaction_ids = [reaction.id for reaction in model.reactions]
+        self._index = {reaction_id: index for index, reaction_id in enumerate(self.reaction_ids)}
+        stoichiometry = csc_matrix(create_stoichiometric_matrix(model, array_type="lil"))
+
+        lp = highspy.HighsLp()
+        lp.num_col_ = stoichiometry.shape[1]
+        lp.num_row_ = stoichiometry.shape[0]
+        lp.col_cost_ = np.array([reaction.objective_coefficient for reaction in model.reactions], dtype=float)
+        lp.col_lower_ = np.array([reaction.lower_bound for reaction in model.reactions], dtype=float)
+        lp.col_upper_ = np.array([reaction.upper_bound for reaction in model.reactions], dtype=float)
+        lp.row_lower_ = np.zeros(lp.num_row_)
+        lp.row_upper_ = np.zeros(lp.num_row_)
+        lp.sense_ = highspy.ObjSense.kMaximize if model.objective_direction == "max" else highspy.ObjSense.kMinimize
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = stoichiometry.indptr
+        lp.a_matrix_.index_ = stoichiometry.indices
+        lp.a_matrix_.value_ = stoichiometry.data
+        self.upper = np.array(lp.col_upper_)
+
+        self.highs = highspy.Highs()
+        self.highs.setOptionValue("output_flag", False)
+        self.highs.passModel(lp)
+        self.status = None
+
+    def indices(self, reaction_ids):
+        """Returns the column indices of the given reactions"""
+        return np.array([self._index[reaction_id] for reaction_id in reaction_ids], dtype=np.int32)
+
+    def set_lower_bounds(self, indices, lower_bounds):
+        """Set the lower bounds of the columns at the given indices, keeping their upper bounds"""
+        lower_bounds = np.asarray(lower_bounds, dtype=float)
+        self.highs.changeColsBounds(len(indices), indices, lower_bounds, self.upper[indices])
+
+    def optimize(self):
+        """Solve the LP, warm-starting from the previous basis. Returns the model status as a string ("optimal", ...)"""
+        self.highs.run()
+        self.status = self.highs.modelStatusToString(self.highs.getModelStatus()).lower()
+        return self.status
+
+    def fluxes(self, indices=None):
+        """Returns the primal values of the last solve, for all columns or the given indices"""
+        values = np.asarray(self.highs.getSolution().col_value)
+        return values if indices is None else values[indices]
+
+    @property
+    def objective_value(self):
+        return self.highs.getInfo().objective_function_value
+
+    @property
+    def iterations(self):
+        """Simplex iterations of the last solve"""
+        return self.highs.getInfo().simplex_iteration_count
+
+#=======
+# TESTS
+#=======
+
+def test_solve_batch():
+    from cdFBA.utils import model_from_file
+    from cdFBA.processes.dfba import get_textbook_test_case
+    config, _ = get_textbook_test_case()
+    model = model_from_file("textbook")
+    exchanges = ["EX_glc__D_e", "EX_ac_e"]
+    rng = np.random.default_rng(0)
+    kinetics = np.broadcast_to([config["kinetics"]["D-Glucose"], config["kinetics"]["Acetate"]], (6, 2, 2))
+    lower_bounds = uptake_bounds(kinetics, rng.uniform(0.5, 10, size=(6, 2)))
+    original = model.reactions.EX_glc__D_e.lower_bound
+
+    fluxes = solve_batch(model, exchanges, lower_bounds)
+
+    assert fluxes.shape == (6, 3)
+    assert model.reactions.EX_glc__D_e.lower_bound == original
+    for member in range(6):
+        with model:
+            for reaction_id, bound in zip(exchanges, lower_bounds[member]):
+                model.reactions.get_by_id(reaction_id).lower_bound = bound
+            solution = model.optimize()
+        assert np.isclose(fluxes[member, 0], solution.objective_value)
+        assert np.isclose(fluxes[member, 1], solution.fluxes["EX_glc__D_e"])
+    assert sorted(nearest_neighbor_order(lower_bounds)) == list(range(6))
+
+def test_highs_lp():
+    import pytest
+    pytest.importorskip("highspy")
+    from cdFBA.utils import model_from_file
+    model = model_from_file("textbook")
+    lp = HighsLP(model)
+    exchanges = lp.indices(["EX_glc__D_e", "EX_ac_e"])
+    outputs = lp.indices([get_objective_reaction(model), "EX_glc__D_e", "EX_ac_e"])
+    for bounds in [(-10.0, 0.0), (-2.0, -3.0), (-7.5, -1.0)]:
+        lp.set_lower_bounds(exchanges, bounds)
+        assert lp.optimize() == "optimal"
+        with model:
+            model.reactions.EX_glc__D_e.lower_bound, model.reactions.EX_ac_e.lower_bound = bounds
+            solution = model.optimize()
+        assert np.isclose(lp.objective_value, solution.objective_value)
+        assert np.isclose(lp.fluxes(outputs)[0], solution.objective_value)
+        assert np.isclose(lp.fluxes()[exchanges[0]], solution.fluxes["EX_glc__D_e"])
+
+def test_dfba_highs_solver(core):
+    import pytest
+    pytest.importorskip("highspy")
+    from cdFBA.processes.dfba import dFBA, get_textbook_test_case
+    config, inputs = get_textbook_test_case()
+    exact = dFBA(config, core).update(inputs, 1.0)["dfba_update"]
+    for key, value in dFBA(dict(config, solver="highs"), core).update(inputs, 1.0)["dfba_update"].items():
+        assert np.isclose(value, exact[key])
@@ -0,0 +1,272 @@
+"""This module contains a direct solver for the steady states of a cdFBA community in a chemostat.
+
+With dilution rate D, feed concentrations F, biomass concentrations X and substrate concentrations S, the community
+of a `make_cdfba_composite` spec run with a `Chemostat` process and the same `dilution_rate` for every species follows
+    dX_i/dt = (mu_i(S) - D) X_i
+    dS_j/dt = D (F_j - S_j) + sum_i v_ij(S) X_i
+where mu_i and v_ij are the growth rate and exchange fluxes of species i from its LP under the Michaelis-Menten
+uptake bounds at S. At a steady state every surviving species grows at the dilution rate and every substrate is
+balanced, so for a given set of survivors the steady state is the root of a square nonlinear system, found here by
+least squares with the species LPs solved in the loop.
+
+`find_steady_states` tries all 2^n sets of survivors, from the largest down to washout, so it is limited to communities
+of `max_species` species (10 by default, 1024 sets). `continue_steady_states` follows a stable state from one dilution
+rate to the next and only tries the previous survivors and the sets that differ from them by one species, searching
+all sets only when none of those gives a stable state. A steady state is kept if the survivors have positive biomass
+and no absent species could invade (mu_k(S) < D). It is stable if the eigenvalues of the Jacobian of the full system
+have negative real parts.
+"""
+import copy
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+
+from cdFBA.utils import SPECIES_STORE
+from cdFBA.solvers import solve_batch
+
+class ChemostatCommunity:
+    """The species LPs of a cdFBA composite spec, evaluated at given substrate concentrations
+
+    Parameters:
+        spec: dict, cdFBA composite spec (see `make_cdfba_composite`)
+        core: process-bigraph core with the cdFBA types registered. Created if not given
+    """
+    def __init__(self, spec, core=None):
+        from cdFBA.processes.dfba import dFBA
+        if core is None:
+            from process_bigraph import allocate_core
+            from cdFBA.data_types import register_types
+            core = register_types(allocate_core())
+        self.species = list(spec[SPECIES_STORE].keys())
+        self.processes = [dFBA(copy.deepcopy(spec[SPECIES_STORE][name]["config"]), core) for name in self.species]
+        self.substrates = list(dict.fromkeys(
+            substrate for process in self.processes for substrate in process.config["reaction_map"]))
+        self.lp_solves = 0
+
+    def rates(self, concentrations, species=None):
+        """Returns the growth rates and substrate exchange fluxes per unit biomass at the given concentrations
+        Parameters:
+            concentrations: np.ndarray, concentration of each substrate, in the order of `substrates`
+            species: list of int, indices of the species to solve, defaults to all
+        Returns:
+            growth: np.ndarray, (species,) growth rates, 0 where the LP is not optimal
+            exchanges: np.ndarray, (species, substrates) exchange fluxes, 0 where the LP is not optimal
+        """
+        species = range(len(self.processes)) if species is None else species
+        environment = dict(zip(self.substrates, np.maximum(concentrations, 0.0)))
+        growth = np.zeros(len(species))
+        exchanges = np.zeros((len(species), len(self.substrates)))
+        for row, index in enumerate(species):
+            process = self.processes[index]
+            reaction_map = process.config["reaction_map"]
+            fluxes = solve_batch(process.model, list(reaction_map.values()), [process.uptake_bounds(environment)])[0]
+            self.lp_solves += 1
+            if np.isnan(fluxes).any():
+                continue
+            growth[row] = fluxes[0]
+            for substrate, flux in zip(reaction_map, fluxes[1:]):
+                exchanges[row, self.substrates.index(substrate)] = flux
+        return growth, exchanges
+
+    def derivatives(self, concentrations, biomass, dilution_rate, feed):
+        """Returns dS/dt and dX/dt of the chemostat community"""
+        growth, exchanges = self.rates(concentrations)
+        return dilution_rate * (feed - concentrations) + exchanges.T @ biomass, (growth - dilution_rate) * biomass
+
+    def jacobian(self, concentrations, biomass, dilution_rate, feed, step=1e-6):
+        """Returns the finite difference Jacobian of the full system in (S, X)"""
+        state = np.concatenate([concentrations, biomass])
+        m = len(concentrations)
+
+        def system(x):
+            dS, dX = self.derivatives(x[:m], x[m:], dilution_rate, feed)
+            return np.concatenate([dS, dX])
+
+        base = system(state)
+        jacobian = np.zeros((len(state), len(state)))
+        for column in range(len(state)):
+            shifted = state.copy()
+            shifted[column] += step * max(1.0, abs(state[column]))
+            jacobian[:, column] = (system(shifted) - base) / (shifted[column] - state[column])
+        return jacobian
+
+def _initial_biomass(community, survivors, feed):
+    """Returns a biomass guess for the survivors from their yields on the feed"""
+    growth, exchanges = community.rates(feed, survivors)
+    uptake = np.maximum(-exchanges, 0.0).sum(axis=1)
+    yields = np.where(uptake > 0, growth / np.where(uptake > 0, uptake, 1.0), 0.0)
+    return np.maximum(yields * feed.sum() / max(len(survivors), 1), 1e-3)
+
+def _solve_survivors(community, survivors, dilution_rate, feed, guess=None, tolerance=1e-6):
+    """Solve for the steady state with the given surviving species. Returns (concentrations, biomass) or None"""
+    m, k = len(community.substrates), len(survivors)
+    if k == 0:
+        return feed.copy(), np.zeros(len(community.species))
+    if guess is None:
+        guess = np.concatenate([0.5 * feed, _initial_biomass(community, survivors, feed)])
+    scale = max(feed.max(), 1.0)
+
+    def residuals(x):
+        concentrations, biomass = x[:m], x[m:]
+        growth, exchanges = community.rates(concentrations, survivors)
+        balance = dilution_rate * (feed - concentrations) + exchanges.T @ biomass
+        return np.concatenate([(growth - dilution_rate) / dilution_rate, balance / (dilution_rate * scale)])
+
+    solution = least_squares(residuals, guess, bounds=(0.0, np.inf), xtol=1e-12, ftol=1e-12, gtol=1e-12)
+    if np.abs(solution.fun).max() > tolerance:
+        return None
+    biomass = np.zeros(len(community.species))
+    biomass[list(survivors)] = solution.x[m:]
+    return solution.x[:m], biomass
+
+def _operating_point(community, survivors, concentrations, biomass, dilution_rate, feed, tolerance):
+    """Returns the steady state as a dict if it is feasible and uninvadable, otherwise None"""
+    if (biomass[list(survivors)] <= tolerance).any():
+        return None
+    growth, _ = community.rates(concentrations)
+    absent = [index for index in range(len(community.species)) if index not in survivors]
+    if (growth[absent] >= dilution_rate - tolerance).any():
+        return None
+    eigenvalues = np.linalg.eigvals(community.jacobian(concentrations, biomass, dilution_rate, feed))
+    return {
+        "dilution_rate": dilution_rate,
+        "survivors": [community.species[index] for index in survivors],
+        "concentrations": dict(zip(community.substrates, concentrations)),
+        "biomass": dict(zip(community.species, biomass)),
+        "growth_rates": dict(zip(community.species, growth)),
+        "stable": bool(eigenvalues.real.max() < tolerance),
+        "max_eigenvalue": float(eigenvalues.real.max()),
+    }
+
+def _neighbor_sets(survivors, size):
+    """Returns the sets of survivors that differ from `survivors` by one species, removals first"""
+    removed = [tuple(index for index in survivors if index != dropped) for dropped in survivors]
+    added = [tuple(sorted((*survivors, index))) for index in range(size) if index not in survivors]
+    return removed + added
+
+def find_steady_states(spec, dilution_rate, feed_concentrations, core=None, community=None, tolerance=1e-6,
+                       max_species=10):
+    """Find the steady states of a cdFBA community in a chemostat, for every set of surviving species
+    Parameters:
+        spec: dict, cdFBA composite spec (see `make_cdfba_composite`)
+        dilution_rate: float, chemostat dilution rate
+        feed_concentrations: dict, feed concentration of each substrate, 0 for substrates not given
+        core: process-bigraph core with the cdFBA types registered
+        community: ChemostatCommunity, reused instead of building the species LPs from the spec
+        tolerance: float, largest scaled residual of a steady state
+        max_species: int, largest community searched. Every one of the 2^n sets of survivors is solved
+    Returns:
+        states: list of dict, steady states with "survivors", "concentrations", "biomass", "growth_rates" and
+                "stable", sorted with stable states first, then by total biomass
+    """
+    community = community or ChemostatCommunity(spec, core)
+    if len(community.species) > max_species:
+        raise ValueError(f"Searching all {2 ** len(community.species)} sets of survivors of {len(community.species)} "
+                         f"species exceeds max_species={max_species}")
+    feed = np.array([feed_concentrations.get(substrate, 0.0) for substrate in community.substrates], dtype=float)
+    states = []
+    for size in range(len(community.species), -1, -1):
+        for survivors in itertools.combinations(range(len(community.species)), size):
+            solution = _solve_survivors(community, survivors, dilution_rate, feed, tolerance=tolerance)
+            if solution is None:
+                continue
+            state = _operating_point(community, survivors, *solution, dilution_rate, feed, tolerance)
+            if state is not None:
+                states.append(state)
+    return sorted(states, key=lambda state: (not state["stable"], -sum(state["biomass"].values())))
+
+def continue_steady_states(spec, dilution_rates, feed_concentrations, core=None, tolerance=1e-6, max_species=10):
+    """Follow the stable steady state of a chemostat community over a range of dilution rates
+    Each dilution rate starts from the steady state of the previous one. When the previous survivors no longer give a
+    stable steady state, the sets of survivors that differ from them by one species are tried, and all sets only if
+    none of those is stable.
+    Parameters:
+        spec: dict, cdFBA composite spec (see `make_cdfba_composite`)
+        dilution_rates: list of float, in the order to follow
+        feed_concentrations: dict, feed concentration of each substrate
+        core: process-bigraph core with the cdFBA types registered
+        tolerance: float, largest scaled residual of a steady state
+        max_species: int, largest community for the search over all sets of survivors (see `find_steady_states`)
+    Returns:
+        results: pd.DataFrame, one row per dilution rate with the survivors, the biomass and substrate concentrations,
+                 and whether the state is stable. NaN where no stable steady state was found
+    """
+    community = ChemostatCommunity(spec, core)
+    feed = np.array([feed_concentrations.get(substrate, 0.0) for substrate in community.substrates], dtype=float)
+    rows = []
+    previous = None
+    for dilution_rate in dilution_rates:
+        state = None
+        if previous is not None:
+            survivors = tuple(community.species.index(name) for name in previous["survivors"])
+            guess = np.concatenate([
+                [previous["concentrations"][substrate] for substrate in community.substrates],
+                [previous["biomass"][community.species[index]] for index in survivors],
+            ])
+            for candidate in [survivors, *_neighbor_sets(survivors, len(community.species))]:
+                start = guess if candidate == survivors else None
+                solution = _solve_survivors(community, candidate, dilution_rate, feed, start, tolerance)
+                if solution is None:
+                    continue
+                state = _operating_point(community, candidate, *solution, dilution_rate, feed, tolerance)
+                if state is not None and state["stable"]:
+                    break
+                state = None
+        if state is None:
+            states = find_steady_states(spec, dilution_rate, feed_concentrations, community=community,
+                                        tolerance=tolerance, max_species=max_species)
+            state = states[0] if states and states[0]["stable"] else None
+        previous = state
+
+        row = {"dilution_rate": dilution_rate}
+        if state is None:
+            row["stable"] = False
+        else:
+            row["survivors"] = ", ".join(state["survivors"])
+            row["stable"] = True
+            row.update({f"biomass/{name}": value for name, value in state["biomass"].items()})
+            row.update({f"concentration/{name}": value for name, value in state["concentrations"].items()})
+        rows.append(row)
+    return pd.DataFrame(rows).set_index("dilution_rate")
+
+#=======
+# TESTS
+#=======
+
+def test_chemostat_steady_state():
+    from scipy.integrate import solve_ivp
+    from cdFBA.utils import make_cdfba_composite, set_kinetics
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=1)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    feed = {"D-Glucose": 5.0, "Acetate": 0.0}
+
+    community = ChemostatCommunity(spec)
+    states = find_steady_states(spec, 0.3, feed, community=community)
+    state = states[0]
+    assert state["stable"] and state["survivors"] == ["E.coli"]
+    assert np.isclose(state["growth_rates"]["E.coli"], 0.3, atol=1e-5)
+    # washout is a steady state too, but E. coli can invade it
+    assert all(state["survivors"] for state in states)
+    # the search over all sets of survivors is capped
+    import pytest
+    with pytest.raises(ValueError, match="max_species"):
+        find_steady_states(spec, 0.3, feed, community=community, max_species=0)
+
+    # integrating the chemostat equations from a small inoculum ends at the same operating point
+    concentrations = np.array([feed[substrate] for substrate in community.substrates])
+    m = len(concentrations)
+
+    def system(time, x):
+        return np.concatenate(community.derivatives(x[:m], x[m:], 0.3, concentrations))
+
+    final = solve_ivp(system, (0, 60), [*concentrations, 0.1], method="LSODA", rtol=1e-6, atol=1e-9).y[:, -1]
+    assert np.isclose(final[m], state["biomass"]["E.coli"], rtol=1e-3)
+    assert np.isclose(final[community.substrates.index("D-Glucose")], state["concentrations"]["D-Glucose"], rtol=1e-2)
+
+    # above the largest growth rate only washout is left
+    results = continue_steady_states(spec, [0.2, 0.5, 1.5], feed)
+    assert list(results["stable"]) == [True, True, True]
+    assert results.loc[0.5, "biomass/E.coli"] > 0
+    assert results.loc[1.5, "biomass/E.coli"] == 0
+    assert np.isclose(results.loc[1.5, "concentration/D-Glucose"], 5.0)
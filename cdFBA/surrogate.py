@@ -0,0 +1,218 @@
+"""This module contains a precomputed response-surface surrogate of a species FBA problem.
+
+For the few exchanges in a dFBA `reaction_map`, the growth rate and exchange fluxes are piecewise-linear functions of
+the exchange lower bounds. `FBASurrogate` samples the LP on a regular grid over a box of lower bounds and evaluates
+new bounds by multilinear interpolation between the grid vertices. The LP is also solved at the center of every grid
+cell, and the largest interpolation error at the center is stored as the error estimate of the cell. `evaluate`
+returns None outside the box, and in cells whose error estimate exceeds the tolerance, so the caller can fall back to
+the LP. A surrogate built for a dFBA process carries the `dfba_surrogate_signature` of its config, so a saved table is
+only reused by processes with the same model, changes, reaction map order, kinetics and grid.
+"""
+import json
+import itertools
+import numpy as np
+
+from cdFBA.utils import get_objective_reaction
+from cdFBA.solvers import solve_batch, solve_signature
+
+class FBASurrogate:
+    """Multilinear lookup table of FBA fluxes over a box of exchange lower bounds
+
+    Parameters:
+        reaction_ids: list of str, exchange reactions whose lower bounds are the table axes
+        outputs: list of str, reactions whose fluxes are tabulated
+        low: np.ndarray, lower corner of the box, one value per exchange
+        high: np.ndarray, upper corner of the box, one value per exchange
+        values: np.ndarray, fluxes at the grid vertices, shape (points,) * exchanges + (outputs,)
+        errors: np.ndarray, error estimate of each grid cell, shape (points - 1,) * exchanges
+        signature: str, identifies the dFBA config the surrogate was built for (see `dfba_surrogate_signature`)
+    """
+    def __init__(self, reaction_ids, outputs, low, high, values, errors, signature=None):
+        self.reaction_ids = list(reaction_ids)
+        self.outputs = list(outputs)
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.signature = signature
+        self.points = self.values.shape[0]
+        self.step = np.where(self.high > self.low, (self.high - self.low) / (self.points - 1), 1.0)
+
+    @classmethod
+    def build(cls, model, reaction_ids, low, high, points=9, outputs=None):
+        """Sample the LP of a model over a box of exchange lower bounds
+        Parameters:
+            model: cobra model
+            reaction_ids: list of str, exchange reactions whose lower bounds are sampled
+            low: list of float, lowest lower bound of each exchange (e.g. -Vmax)
+            high: list of float, highest lower bound of each exchange (e.g. 0)
+            points: int, grid points per exchange (at least 2)
+            outputs: list of str, tabulated reactions. Defaults to the objective reaction followed by `reaction_ids`
+        Returns:
+            surrogate: FBASurrogate
+        """
+        if points < 2:
+            raise ValueError("A surrogate needs at least 2 grid points per exchange")
+        if outputs is None:
+            outputs = [get_objective_reaction(model)] + list(reaction_ids)
+        low = np.asarray(low, dtype=float)
+        high = np.asarray(high, dtype=float)
+        dimensions = len(reaction_ids)
+
+        axes = [np.linspace(lo, hi, points) for lo, hi in zip(low, high)]
+        vertices = np.array(list(itertools.product(*axes))).reshape(-1, dimensions)
+        centers = np.array(list(itertools.product(*[(axis[1:] + axis[:-1]) / 2 for axis in axes]))).reshape(-1, dimensions)
+        fluxes = solve_batch(model, reaction_ids, np.vstack([vertices, centers]), outputs)
+
+        values = fluxes[:len(vertices)].reshape((points,) * dimensions + (len(outputs),))
+        surrogate = cls(reaction_ids, outputs, low, high, values, np.zeros((points - 1,) * dimensions))
+        # cells with an infeasible vertex or center are never used
+        errors = np.full(len(centers), np.inf)
+        for index, (center, exact) in enumerate(zip(centers, fluxes[len(vertices):])):
+            estimate = surrogate.interpolate(center)
+            if not (np.isnan(exact).any() or np.isnan(estimate).any()):
+                errors[index] = np.abs(estimate - exact).max()
+        surrogate.errors = errors.reshape((points - 1,) * dimensions)
+        return surrogate
+
+    def interpolate(self, bounds):
+        """Returns the interpolated fluxes at a point inside the box, ignoring the error estimates"""
+        position = (np.asarray(bounds, dtype=float) - self.low) / self.step
+        cell = np.clip(position.astype(int), 0, self.points - 2)
+        fraction = position - cell
+        corners = self.values[tuple(slice(c, c + 2) for c in cell)]
+        for f in fraction:
+            corners = corners[0] * (1 - f) + corners[1] * f
+        return corners
+
+    def evaluate(self, bounds, tolerance=np.inf):
+        """Returns the fluxes at the given exchange lower bounds
+        Parameters:
+            bounds: list of float, lower bound of each exchange, in the order of `reaction_ids`
+            tolerance: float, largest accepted error estimate of the grid cell
+        Returns:
+            fluxes: np.ndarray, fluxes of `outputs`, or None outside the box or if the cell error exceeds `tolerance`
+        """
+        bounds = np.asarray(bounds, dtype=float)
+        if (bounds < self.low).any() or (bounds > self.high).any():
+            return None
+        cell = np.clip(((bounds - self.low) / self.step).astype(int), 0, self.points - 2)
+        if not self.errors[tuple(cell)] <= tolerance:
+            return None
+        return self.interpolate(bounds)
+
+    def save(self, path):
+        """Save the surrogate to a .npz file"""
+        np.savez(
+            path,
+            reaction_ids=np.array(self.reaction_ids),
+            outputs=np.array(self.outputs),
+            low=self.low,
+            high=self.high,
+            values=self.values,
+            errors=self.errors,
+            signature=np.array(self.signature or ""),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load a surrogate saved with `save`"""
+        with np.load(path) as data:
+            return cls(
+                [str(reaction_id) for reaction_id in data["reaction_ids"]],
+                [str(output) for output in data["outputs"]],
+                data["low"],
+                data["high"],
+                data["values"],
+                data["errors"],
+                (str(data["signature"]) or None) if "signature" in data.files else None,
+            )
+
+def dfba_surrogate_signature(config, points=9):
+    """Returns a string identifying the surrogate of a dFBA config: its LP (see `solve_signature`), the reaction map
+    order, the kinetics that set the box and the number of grid points
+    Parameters:
+        config: dict, dFBA config, with the kinetics changes already applied
+        points: int, grid points per exchange
+    Returns:
+        signature: str
+    """
+    kinetics = [config["kinetics"][substrate] for substrate in config["reaction_map"]]
+    return json.dumps([solve_signature(config), kinetics, points], default=str)
+
+def build_dfba_surrogate(model, reaction_map, kinetics, points=9, signature=None):
+    """Build the surrogate covering every lower bound a dFBA process with the given kinetics can set, from -Vmax to 0
+    Parameters:
+        model: cobra model
+        reaction_map: dict, maps substrate names to reaction IDs
+        kinetics: dict, dictionary of tuples with kinetic parameters (km, Vmax)
+        points: int, grid points per exchange
+        signature: str, `dfba_surrogate_signature` of the dFBA config, stored with the surrogate
+    Returns:
+        surrogate: FBASurrogate
+    """
+    substrates = list(reaction_map.keys())
+    low = [-kinetics[substrate][1] for substrate in substrates]
+    high = [0.0] * len(substrates)
+    surrogate = FBASurrogate.build(model, [reaction_map[substrate] for substrate in substrates], low, high, points)
+    surrogate.signature = signature
+    return surrogate
+
+#=======
+# TESTS
+#=======
+
+def test_surrogate(tmp_path):
+    from cdFBA.utils import model_from_file
+    from cdFBA.processes.dfba import get_textbook_test_case
+    config, _ = get_textbook_test_case()
+    model = model_from_file("textbook")
+    reaction_map = {"D-Glucose": "EX_glc__D_e", "Acetate": "EX_ac_e"}
+    surrogate = build_dfba_surrogate(model, reaction_map, config["kinetics"], points=9)
+    assert surrogate.values.shape == (9, 9, 3)
+
+    # vertices are exact
+    vertex = surrogate.low + 2 * surrogate.step
+    with model:
+        model.reactions.EX_glc__D_e.lower_bound, model.reactions.EX_ac_e.lower_bound = vertex
+        exact = model.slim_optimize()
+    assert np.isclose(surrogate.evaluate(vertex)[0], exact)
+
+    # interpolated points are within the cell error estimates where they are accepted
+    for bounds in [(-5.3, -1.1), (-11.0, -6.2), (-0.7, -3.3)]:
+        with model:
+            model.reactions.EX_glc__D_e.lower_bound, model.reactions.EX_ac_e.lower_bound = bounds
+            exact = model.slim_optimize()
+        fluxes = surrogate.evaluate(bounds, tolerance=1e-6)
+        if fluxes is not None:
+            assert np.isclose(fluxes[0], exact, atol=1e-6)
+    assert surrogate.evaluate((-16.0, 0.0)) is None
+    assert surrogate.evaluate((-5.3, -1.1), tolerance=-1) is None
+
+    surrogate.save(tmp_path / "surrogate.npz")
+    loaded = FBASurrogate.load(tmp_path / "surrogate.npz")
+    assert loaded.reaction_ids == surrogate.reaction_ids
+    assert np.array_equal(loaded.evaluate((-5.3, -1.1)), surrogate.evaluate((-5.3, -1.1)))
+
+def test_dfba_surrogate_mode(tmp_path, core):
+    import pytest
+    from cdFBA.processes.dfba import dFBA, get_textbook_test_case
+    config, inputs = get_textbook_test_case()
+    exact = dFBA(config, core).update(inputs, 1.0)["dfba_update"]
+    path = str(tmp_path / "surrogate.npz")
+    process = dFBA(dict(config, surrogate={"points": 5, "tolerance": np.inf, "path": path}), core)
+    approximate = process.update(inputs, 1.0)["dfba_update"]
+    for key, value in exact.items():
+        assert np.isclose(approximate[key], value, rtol=0.05, atol=1e-3)
+    assert FBASurrogate.load(path).signature == dfba_surrogate_signature(process.config, 5)
+
+    # a surrogate saved for another reaction map is rebuilt instead of being evaluated on the wrong exchanges
+    config = dict(config, reaction_map={"D-Glucose": "EX_glc__D_e"})
+    exact = dFBA(config, core).update(inputs, 1.0)["dfba_update"]
+    with pytest.warns(UserWarning, match="rebuilding"):
+        process = dFBA(dict(config, surrogate={"points": 5, "tolerance": np.inf, "path": path}), core)
+    assert process.surrogate.reaction_ids == ["EX_glc__D_e"]
+    approximate = process.update(inputs, 1.0)["dfba_update"]
+    for key, value in exact.items():
+        assert np.isclose(approximate[key], value, rtol=0.05, atol=1e-3)
+    assert FBASurrogate.load(path).signature == dfba_surrogate_signature(process.config, 5)
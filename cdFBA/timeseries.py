@@ -0,0 +1,137 @@
+"""This module contains a streaming reader of measured time courses, used to drive Shared Environment concentrations.
+
+Supported files, with one row per time point in increasing time order:
+    .npy        2D array with the time in the first column, memory-mapped. Column names are given separately
+    .csv        header row with a time column, read in chunks
+    .parquet    time column, read in record batches (requires pyarrow)
+
+Only one chunk (and the last row of the previous one) is held in memory. `TimeSeries.value` interpolates all columns
+at once and moves a cursor forward with time, so a simulation reads the file once from start to end. Going back in
+time reopens the file.
+"""
+import numpy as np
+import pandas as pd
+
+def _npy_chunks(path, columns, time_column, chunk_size):
+    data = np.load(path, mmap_mode="r")
+    for start in range(0, data.shape[0], chunk_size):
+        block = np.asarray(data[start:start + chunk_size], dtype=float)
+        yield block[:, 0], block[:, 1:]
+
+def _csv_chunks(path, columns, time_column, chunk_size):
+    for chunk in pd.read_csv(path, usecols=[time_column, *columns], chunksize=chunk_size):
+        yield chunk[time_column].to_numpy(dtype=float), chunk[columns].to_numpy(dtype=float)
+
+def _parquet_chunks(path, columns, time_column, chunk_size):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading parquet time series requires pyarrow (pip install pyarrow)")
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=[time_column, *columns]):
+        chunk = batch.to_pandas()
+        yield chunk[time_column].to_numpy(dtype=float), chunk[columns].to_numpy(dtype=float)
+
+def _file_columns(path, time_column):
+    """Returns the non-time columns of a CSV or parquet file"""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        names = pq.ParquetFile(path).schema_arrow.names
+    else:
+        names = list(pd.read_csv(path, nrows=0).columns)
+    return [name for name in names if name != time_column]
+
+class TimeSeries:
+    """Linear interpolation of the columns of a time-series file, streamed forward in time
+
+    Parameters:
+        path: str, .npy, .csv or .parquet file
+        columns: list of str, columns to read. Required for .npy files, where they name the columns after the time
+                 column in order. Defaults to all non-time columns otherwise
+        time_column: str, name of the time column of CSV and parquet files
+        chunk_size: int, rows read at once
+    """
+    def __init__(self, path, columns=None, time_column="time", chunk_size=10000):
+        path = str(path)
+        if path.endswith(".npy"):
+            if columns is None:
+                raise ValueError("Provide the column names of a .npy time series")
+            self._reader = _npy_chunks
+        elif path.endswith(".csv"):
+            self._reader = _csv_chunks
+        elif path.endswith(".parquet"):
+            self._reader = _parquet_chunks
+        else:
+            raise ValueError(f"Unsupported time series file {path}")
+        self.path = path
+        self.columns = list(columns) if columns is not None else _file_columns(path, time_column)
+        self.time_column = time_column
+        self.chunk_size = chunk_size
+        self.rewind()
+
+    def rewind(self):
+        """Reopen the file at its first chunk"""
+        self._chunks = self._reader(self.path, self.columns, self.time_column, self.chunk_size)
+        self.times, self.values = next(self._chunks)
+        self.cursor = 0
+        self.first_chunk = True
+        self.exhausted = False
+
+    def _next_chunk(self):
+        """Read the next chunk, keeping the last row of the current one. Returns False at the end of the file"""
+        try:
+            times, values = next(self._chunks)
+        except StopIteration:
+            self.exhausted = True
+            return False
+        self.times = np.concatenate([self.times[-1:], times])
+        self.values = np.concatenate([self.values[-1:], values])
+        self.cursor = 0
+        self.first_chunk = False
+        return True
+
+    def value(self, time):
+        """Returns the values of all columns at the given time, held constant before the first and after the last row
+        Parameters:
+            time: float
+        Returns:
+            values: np.ndarray, one value per column
+        """
+        if time < self.times[self.cursor]:
+            # going back in time: start over from the beginning of the file
+            if not (self.first_chunk and self.cursor == 0):
+                self.rewind()
+            if time < self.times[0]:
+                return self.values[0].copy()
+        # move the cursor forward so that times[cursor] <= time < times[cursor + 1], reading chunks as needed
+        while time >= self.times[-1]:
+            if self.exhausted or not self._next_chunk():
+                self.cursor = len(self.times) - 1
+                return self.values[-1].copy()
+        self.cursor += int(np.searchsorted(self.times[self.cursor:], time, side="right")) - 1
+        start, end = self.times[self.cursor], self.times[self.cursor + 1]
+        fraction = (time - start) / (end - start)
+        return self.values[self.cursor] + fraction * (self.values[self.cursor + 1] - self.values[self.cursor])
+
+#=======
+# TESTS
+#=======
+
+def test_time_series(tmp_path):
+    times = np.linspace(0, 10, 101)
+    data = np.column_stack([times, 2 * times, np.sin(times)])
+    np.save(tmp_path / "series.npy", data)
+    pd.DataFrame({"time": times, "A": data[:, 1], "B": data[:, 2]}).to_csv(tmp_path / "series.csv", index=False)
+
+    npy = TimeSeries(tmp_path / "series.npy", columns=["A", "B"], chunk_size=7)
+    csv = TimeSeries(tmp_path / "series.csv", chunk_size=7)
+    assert csv.columns == ["A", "B"]
+    for series in (npy, csv):
+        for time in [0.0, 0.05, 0.7, 3.33, 3.4, 9.95]:
+            expected = [2 * time, np.interp(time, times, data[:, 2])]
+            assert np.allclose(series.value(time), expected)
+        # only one chunk is in memory
+        assert len(series.times) <= 8
+        # held constant outside the measured range, and read again from the start when going back in time
+        assert np.allclose(series.value(12.0), data[-1, 1:])
+        assert np.allclose(series.value(-1.0), data[0, 1:])
+        assert np.allclose(series.value(5.05), [10.1, np.interp(5.05, times, data[:, 2])])
@@ -5,8 +5,6 @@ CAUTION: The initial conditions, and kinetics dataframes provide default paramet
 CAUTION: Substrate names are different in BiGG and AGORA databases. These functions will not work with two models form
          different sources
 """
-from cobra.io import load_model, read_sbml_model, load_json_model, load_yaml_model, load_matlab_model
-from cobra.medium import minimal_medium
 import pprint
 import re
 
@@ -16,6 +14,8 @@ SPECIES_STORE = "Species"
 DFBA_RESULTS = "dFBA Results"
 THRESHOLDS = "Thresholds"
 FIELDS = "Fields"
+SOLVER_TELEMETRY = "Solver Telemetry"
+CONVERGENCE = "Convergence"
 
 #basic functions
 def model_from_file(model_file="textbook"):
@@ -25,6 +25,8 @@ def model_from_file(model_file="textbook"):
     Returns:
         model: cobra model
     """
+    # cobra is only imported when the first model is loaded
+    from cobra.io import load_model, read_sbml_model, load_json_model, load_yaml_model, load_matlab_model
     #check for model type and load model
     if ".xml" in model_file:
         model = read_sbml_model(model_file)
@@ -41,6 +43,21 @@ def model_from_file(model_file="textbook"):
         raise ValueError("Invalid model file")
     return model
 
+_MODEL_CACHE = {}
+
+def cached_model(model_file="textbook", copy=True):
+    """Returns a cobra model from a cache of loaded models, loading it with `model_from_file` on first use
+    Parameters:
+        model_file: str, file path or BiGG Model ID
+        copy: bool, if True return a copy that can be modified, otherwise the shared cached model (do not modify)
+    Returns:
+        model: cobra model
+    """
+    if model_file not in _MODEL_CACHE:
+        _MODEL_CACHE[model_file] = model_from_file(model_file)
+    model = _MODEL_CACHE[model_file]
+    return model.copy() if copy else model
+
 def get_model_dict(model_dict):
     """
     Returns a dictionary of the cobra model from a dictionary of model IDs/file paths
@@ -115,6 +132,7 @@ def get_exchanges(model_file="textbook", medium_type="exchange"):
     if medium_type == "default":
         medium = model.medium
     if medium_type == "minimal":
+        from cobra.medium import minimal_medium
         medium = minimal_medium(model, model.slim_optimize()).to_dict()
     if medium_type == "exchange":
         medium = {reaction.id: reaction.upper_bound for reaction in model.exchanges}
@@ -278,7 +296,9 @@ def get_single_dfba_spec(
         model_file="textbook",
         name="species",
         config=None,
-        interval=1.0
+        interval=1.0,
+        telemetry=False,
+        narrow_inputs=True,
 ):
     """Constructs a configuration dictionary for a dynamic FBA process
     Parameters:
@@ -286,6 +306,9 @@ def get_single_dfba_spec(
         name: str, identifier for the model, usually species/strain name
         config: dict, config for dFBA Process. If none provided, uses default generated using `dfba_config()`
         interval: float, interval between consecutive dFBA calculations
+        telemetry: bool, report solver telemetry to the Solver Telemetry store. Also enabled by "telemetry" in config
+        narrow_inputs: bool, wire the process only to the Shared Environment keys it reads (its reaction_map substrates
+                       and its own biomass) instead of the whole store
     Returns:
         dict: dict, specification dictionary for a single species dFBA
     """
@@ -295,8 +318,10 @@ def get_single_dfba_spec(
         model = model_file
     if config is None:
         config = dfba_config(model_file=model_file, model=model, name=name)
+    if telemetry:
+        config["telemetry"] = True
 
-    return {
+    spec = {
         "_type": "process",
         "address": "local:dFBA",
         "config": config,
@@ -309,9 +334,31 @@ def get_single_dfba_spec(
         },
         "interval": interval
     }
+    if narrow_inputs:
+        spec["inputs"]["shared_environment"] = get_environment_wires([*config["reaction_map"].keys(), name])
+    if config.get("telemetry"):
+        spec["outputs"]["solver_telemetry"] = ["..", SOLVER_TELEMETRY, name]
+    return spec
+
+def get_environment_wires(keys, path=("..", SHARED_ENVIRONMENT)):
+    """Returns wires connecting a port to the volume and to the counts and concentrations of some keys of the Shared
+    Environment
+    Parameters:
+        keys: list of str, substrate and species names
+        path: tuple, path to the Shared Environment store relative to the process
+    Returns:
+        wires: dict, nested wires for the port
+    """
+    wires = {
+        kind: {key: [*path, kind, key] for key in keys}
+        for kind in ("counts", "concentrations")
+    }
+    wires["volume"] = [*path, "volume"]
+    return wires
 
 #multi-species functions
-def make_cdfba_composite(model_dict, medium_type=None, exchanges=None, volume=1, interval=1.0):
+def make_cdfba_composite(model_dict, medium_type=None, exchanges=None, volume=1, interval=1.0, telemetry=False,
+                         multirate=None, share_solves=False):
     """Construct a cdfba composite spec with all exhange metabolites included.
     Parameters:
         model_dict : dict, dictionary with cdfba process names as keys and model name/path as values
@@ -323,6 +370,9 @@ def make_cdfba_composite(model_dict, medium_type=None, exchanges=None, volume=1,
         exchanges: a list of exchange reaction ids. MUST be None if medium_type is provided
         volume: float, volume of cdfba composite
         interval: float, interval between consecutive dFBA calculations
+        telemetry: bool, report the solver telemetry of every species to the Solver Telemetry store
+        multirate: dict, multi-rate settings for every species (see `dFBA`), or None to solve every interval
+        share_solves: bool, species with identical models and uptake bounds solve their LP once per time step
     Returns:
         spec : dict, cdfba composite spec
     """
@@ -371,17 +421,24 @@ def make_cdfba_composite(model_dict, medium_type=None, exchanges=None, volume=1,
             reaction_map=reaction_map,
             bounds=bounds
         )
+        if multirate is not None:
+            config["multirate"] = dict(multirate)
+        if share_solves:
+            config["share_solves"] = True
         model_spec = get_single_dfba_spec(
             model_file=model_file,
             name=model_name,
             config=config,
-            interval=interval
+            interval=interval,
+            telemetry=telemetry,
         )
         #add dFBA spec to composite spec
         spec[SPECIES_STORE][model_name] = model_spec
         #initialize dFBA results store
         spec[DFBA_RESULTS][model_name] = {substrate: 0 for substrate in substrates}
         spec[DFBA_RESULTS][model_name].update({model_name: 0})
+    if telemetry:
+        spec[SOLVER_TELEMETRY] = {}
     #add UpdateEnvironment step spec
     spec["update environment"] = environment_spec()
     return spec
@@ -539,10 +596,194 @@ def get_injector_spec(config=None, interval=1.0):
         "interval": interval,
     }
 
+def get_chemostat_spec(config=None, interval=1.0):
+    """Constructs a configuration dictionary for the Chemostat process.
+    Parameters:
+        config: dict, Chemostat configuration dictionary with "dilution_rate" and "feed_concentrations"
+    Returns:
+        dict, spec for Chemostat process
+    """
+    if config is None:
+        raise ValueError("Error: Please provide config")
+    return {
+        "_type": "process",
+        "address": "local:Chemostat",
+        "config": config,
+        "inputs": {
+            "shared_environment": [SHARED_ENVIRONMENT],
+        },
+        "outputs": {
+            "shared_environment": [SHARED_ENVIRONMENT],
+        },
+        "interval": interval,
+    }
+
+def get_timeseries_spec(config=None, interval=1.0):
+    """Constructs a configuration dictionary for the TimeSeriesConcentration process.
+    Parameters:
+        config: dict, TimeSeriesConcentration configuration dictionary with "path" and optionally "substrates",
+                "time_column" and "chunk_size"
+    Returns:
+        dict, spec for TimeSeriesConcentration process
+    """
+    if config is None:
+        raise ValueError("Error: Please provide config")
+    return {
+        "_type": "process",
+        "address": "local:TimeSeriesConcentration",
+        "config": config,
+        "inputs": {
+            "shared_environment": [SHARED_ENVIRONMENT],
+            "global_time": ["global_time"],
+        },
+        "outputs": {
+            "shared_environment": [SHARED_ENVIRONMENT],
+        },
+        "interval": interval,
+    }
+
+def set_dilution_rate(spec, dilution_rate):
+    """Sets the dilution rate of every species in a cdFBA composite spec
+    Parameters:
+        spec: dict, cdFBA composite spec
+        dilution_rate: float, chemostat dilution rate
+    """
+    for species in spec[SPECIES_STORE].values():
+        species["config"]["dilution_rate"] = dilution_rate
+
+def set_dormancy(spec, threshold, species=None, remove=False):
+    """Sets the dormancy threshold of species in a cdFBA composite spec, below which they stop solving their LP
+    Parameters:
+        spec: dict, cdFBA composite spec
+        threshold: float, biomass concentration below which a species is dormant
+        species: list of str, species to set, defaults to all species
+        remove: bool, also add "remove" thresholds so an EnvironmentMonitor removes dormant species from the composite
+    """
+    for name in (species if species is not None else list(spec[SPECIES_STORE].keys())):
+        spec[SPECIES_STORE][name]["config"]["dormancy_threshold"] = threshold
+        if remove:
+            spec.setdefault(THRESHOLDS, {})[f"{name} dormant"] = {
+                "type": "remove",
+                "substrate": name,
+                "range": {"upper": None, "lower": threshold},
+                "parent": name,
+                "name": name,
+                "changes": {"gene_knockout": [], "reaction_knockout": [], "bounds": {}, "kinetics": {}},
+                "mass": 0.0,
+            }
+
+def get_dormant_species(state):
+    """Returns the species of a composite state whose dFBA process was dormant in its last update, with or without
+    solver telemetry"""
+    return [name for name, node in state.get(SPECIES_STORE, {}).items()
+            if getattr(node.get("instance"), "dormant", False)]
+
+def get_convergence_monitor_spec(config=None):
+    """Constructs a configuration dictionary for the ConvergenceMonitor step.
+    Parameters:
+        config: dict, ConvergenceMonitor configuration dictionary with "window" and any of "relative_change",
+                "growth_tolerance" and "substrate_floor"
+    Returns:
+        dict, spec for ConvergenceMonitor step
+    """
+    if config is None:
+        raise ValueError("Error: Please provide config")
+    return {
+        "_type": "step",
+        "address": "local:ConvergenceMonitor",
+        "config": config,
+        "inputs": {
+            "global_time": ["global_time"],
+            "shared_environment": [SHARED_ENVIRONMENT],
+            "dfba_results": [DFBA_RESULTS],
+        },
+        "outputs": {
+            "convergence": [CONVERGENCE],
+        },
+    }
+
+def get_environment_emitter_spec(capacity=1024, subsample=1):
+    """Constructs a configuration dictionary for the EnvironmentEmitter step.
+    Parameters:
+        capacity: int, number of timepoints to preallocate
+        subsample: int, record every Nth update
+    Returns:
+        dict, spec for EnvironmentEmitter step
+    """
+    return {
+        "_type": "step",
+        "address": "local:EnvironmentEmitter",
+        "config": {
+            "capacity": capacity,
+            "subsample": subsample,
+        },
+        "inputs": {
+            "global_time": ["global_time"],
+            "shared_environment": [SHARED_ENVIRONMENT],
+        },
+    }
+
+def get_chunked_emitter_spec(path, chunk_size=10000, dfba_results=False):
+    """Constructs a configuration dictionary for the ChunkedEmitter step. The last partial chunk is only written
+    by `flush_chunked_emitters(sim)` (or the emitter's `flush`/`close`) after `sim.run`. `run_until_converged`,
+    `run_with_checkpoints` and `gather_emitter_results` flush it themselves
+    Parameters:
+        path: str, output directory
+        chunk_size: int, number of timepoints per chunk file
+        dfba_results: bool, also record the dFBA Results store
+    Returns:
+        dict, spec for ChunkedEmitter step
+    """
+    inputs = {
+        "global_time": ["global_time"],
+        "shared_environment": [SHARED_ENVIRONMENT],
+    }
+    if dfba_results:
+        inputs["dfba_results"] = [DFBA_RESULTS]
+    return {
+        "_type": "step",
+        "address": "local:ChunkedEmitter",
+        "config": {
+            "path": path,
+            "chunk_size": chunk_size,
+            "dfba_results": dfba_results,
+        },
+        "inputs": inputs,
+    }
+
 #=======
 # TESTS
 #=======
 
+def test_narrowed_inputs():
+    from process_bigraph import Composite, allocate_core
+    from cdFBA.data_types import register_types
+    core = register_types(allocate_core())
+    spec = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=2)
+    set_kinetics("E.coli", spec, {"D-Glucose": (0.02, 15), "Acetate": (0.5, 7)})
+    wires = spec[SPECIES_STORE]["E.coli"]["inputs"]["shared_environment"]
+    assert wires["counts"]["D-Glucose"] == ["..", SHARED_ENVIRONMENT, "counts", "D-Glucose"]
+    assert set(wires["concentrations"]) == {"D-Glucose", "Acetate", "E.coli"}
+
+    reference = make_cdfba_composite({"E.coli": "textbook"}, medium_type=None, exchanges=["EX_glc__D_e", "EX_ac_e"], volume=2)
+    reference[SPECIES_STORE]["E.coli"] = get_single_dfba_spec(
+        "textbook", "E.coli", config=spec[SPECIES_STORE]["E.coli"]["config"], narrow_inputs=False)
+    for state in (spec, reference):
+        # substrates that no species consumes
+        state[SHARED_ENVIRONMENT]["counts"]["Unused"] = 4.0
+        state[SHARED_ENVIRONMENT]["concentrations"]["Unused"] = 2.0
+
+    narrowed = Composite({"state": spec}, core=core)
+    full = Composite({"state": reference}, core=core)
+    narrowed.run(3)
+    full.run(3)
+    view = narrowed._cached_view((SPECIES_STORE, "E.coli"))["shared_environment"]
+    assert set(view["counts"]) == {"D-Glucose", "Acetate", "E.coli"}
+    environment = narrowed.state[SHARED_ENVIRONMENT]
+    assert environment["counts"] == full.state[SHARED_ENVIRONMENT]["counts"]
+    for key, count in environment["counts"].items():
+        assert environment["concentrations"][key] == count / environment["volume"]
+
 def run_single_dfba_spec(model_file="textbook"):
     model = model_from_file(model_file)
     exchanges = get_exchanges(model_file=model_file, medium_type="exchange")
@@ -0,0 +1,11 @@
+"""Shared pytest fixtures for the tests at the bottom of the cdFBA modules"""
+import pytest
+
+from process_bigraph import allocate_core
+
+
+@pytest.fixture
+def core():
+    from cdFBA.data_types import register_types
+    # create the core object, with the cdFBA data types and all processes and steps registered
+    return register_types(allocate_core())
@@ -53,8 +53,14 @@ setup(
         "bigraph-schema",
         "bigraph-viz",
         "cobra",
+        "numpy",
+        "scipy",
+        "pandas",
         "matplotlib",
         "ipdb",
-        "pytest"
-    ]
+    ],
+    extras_require={
+        "highs": ["highspy"],
+        "test": ["pytest"],
+    },
 )